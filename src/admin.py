@@ -0,0 +1,30 @@
+import functools
+import hmac
+import ipaddress
+
+from aiohttp import web
+
+# Access control for /admin routes, which share the public port with calls.
+#
+# With a token configured (--admin-token) requests must send it as bearer
+# token, without one only clients on loopback are served.
+
+
+def allowed(request):
+    token = getattr(request.app, 'admin_token', None)
+    if token:
+        header = request.headers.get('Authorization', '')
+        return hmac.compare_digest(header.encode('utf-8'), ('Bearer ' + token).encode('utf-8'))
+    try:
+        return ipaddress.ip_address(request.remote).is_loopback
+    except (TypeError, ValueError):  # unix socket or unknown peer
+        return False
+
+
+def admin_only(handler):
+    @functools.wraps(handler)
+    async def checked(request):
+        if not allowed(request):
+            raise web.HTTPForbidden(text='admin access denied')
+        return await handler(request)
+    return checked
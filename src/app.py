@@ -7,10 +7,18 @@ import ssl
 import uuid
 import uvloop
 
-from aiohttp import web
+from aiohttp import web, ClientSession
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCRtpTransceiver
-from aiortc.contrib.media import MediaRecorder
+from aiortc.contrib.media import MediaBlackhole, MediaRecorder
 import time
+import protocol
+from profiler import profiler
+from processing import ProcessingChain
+from classes import ReSampledAudioStreamTrack, MulticastStreamTrack, MuxAudioStreamTrack
+from admin import admin_only
+from drain import Drainer, DEFAULT_TIMEOUT, wait_until
+from stats import StatsCollector
+from tap import AudioTap
 
 ROOT = os.path.dirname(__file__)
 
@@ -24,13 +32,22 @@ events = [asyncio.Event(), asyncio.Event()]
 
 
 class ConnectionGroup(object):
-    def __init__(self, uid, users):
+    def __init__(self, uid, users, webhook=None, stats=None, tap=None, recorder=None):
         self.uid = uid
+        self.users = users
+        self.webhook = webhook
+        self.stats = stats
+        self.tap = tap
+        self.taps = list()
         self.call_begin = None
         self.full = asyncio.Event()
         self.tracks = dict((k, []) for k in users)
-        self.recorder = MediaRecorder(str(uid) + str(users) + '.mp3')
+        self.recorder = recorder or MediaRecorder(str(uid) + str(users) + '.mp3')
+        self.mix = MuxAudioStreamTrack(uid)  # mp3 takes one stream, users are mixed into it
+        self.recorder.addTrack(self.mix)
         self.future = None
+        self.pcs = set()
+        self.ended = asyncio.Event()
 
     def check_user(self, user_id):
         return user_id in self.tracks.keys()
@@ -39,10 +56,19 @@ class ConnectionGroup(object):
         if not self.call_begin:
             if asyncio.isfuture(self.future):
                 self.future.cancel()
-            self.tracks[user_id].append(track)
+            # shared wrappers, recorder and other users' senders all read same track
             if track.kind == 'audio':
-                self.recorder.addTrack(track)
-            for t in self.tracks:
+                tap = None
+                if self.tap is not None:
+                    tap = self.tap.stream('%s/%s' % (self.uid, user_id))
+                    self.taps.append(tap)
+                # drained until the recording mix and other users' senders subscribe
+                track = ReSampledAudioStreamTrack(
+                    track, self.uid, ProcessingChain(), tap=tap, drain_idle=True)
+            else:
+                track = MulticastStreamTrack(track, drain_idle=True)
+            self.tracks[user_id].append(track)
+            for t in self.tracks.values():
                 if len(t) < 1:
                     break
             else:
@@ -50,10 +76,21 @@ class ConnectionGroup(object):
 
     async def start_call(self):
             await asyncio.sleep(0.3)
+            for track in self.audio_tracks():
+                self.mix.add_track(track)  # subscribes for recorder
             await self.recorder.start()
             self.call_begin = time.time()
             self.full.set()
 
+    def audio_tracks(self):
+        return [track for ts in self.tracks.values() for track in ts if track.kind == 'audio']
+
+    def mute(self, user_id, kind, muted):
+        # paused tracks drop out of the mix, see MuxStreamTrack.update_paused
+        for track in self.tracks.get(user_id, ()):
+            if track.kind == kind:
+                track.pause(muted)
+
     def get_tracks(self, user_id):
         result = list()
         for u, ts in self.tracks.items():
@@ -61,10 +98,40 @@ class ConnectionGroup(object):
                 result.extend(ts)
         return result
 
+    async def remove_pc(self, pc):
+        self.pcs.discard(pc)
+        if not self.pcs:
+            await self.end_call()
+
     async def end_call(self):
-        await self.recorder.stop()
-        call_time = time.time() - self.call_begin
+        if self.ended.is_set():
+            return
+        self.ended.set()
+        if asyncio.isfuture(self.future):
+            self.future.cancel()
         # end all connections
+        await asyncio.gather(*[pc.close() for pc in list(self.pcs)])
+        for tap in self.taps:
+            tap.close()
+        if not self.call_begin:
+            return
+        await self.recorder.stop()  # finalizes record file
+        call_time = time.time() - self.call_begin
+        quality = self.stats.pop_room(self.uid) if self.stats is not None else None
+        await self.send_webhook({'uid': self.uid,
+                                 'users': self.users,
+                                 'call_time': call_time,
+                                 'quality': quality})
+
+    async def send_webhook(self, payload):
+        if not self.webhook:
+            return
+        try:
+            async with ClientSession() as session:
+                async with session.post(self.webhook, json=payload) as response:
+                    logger.info('Webhook for %s answered %s', self.uid, response.status)
+        except Exception:
+            logger.exception('Webhook for %s failed', self.uid)
 
 
 async def index(request):
@@ -79,8 +146,18 @@ async def javascript(request):
 
 class CreateGroup(web.View):
     async def post(self):
+        self.request.app.drainer.check()
         params = await self.request.json()
-        self.request.app.groups[params['uid']] = ConnectionGroup(**params)
+        uid, users = params.get('uid'), params.get('users')
+        if not isinstance(uid, str) or not isinstance(users, list):
+            raise web.HTTPBadRequest(text='uid and users are required')
+        # webhook is server config, clients must not choose where call data goes
+        self.request.app.groups[uid] = ConnectionGroup(
+            uid, users, webhook=self.request.app.webhook,
+            stats=self.request.app.stats, tap=self.request.app.tap)
+        return web.Response(
+            content_type='application/json',
+            text=json.dumps({'uid': uid}))
 
 
 async def offer(request):
@@ -89,9 +166,27 @@ async def offer(request):
         sdp=params['sdp'],
         type=params['type'])
 
+    # calls of a created group pass its uid and their user id, others are paired as before
+    group = None
+    user = params.get('user')
+    if params.get('uid') is not None:
+        group = request.app.groups.get(params['uid'])
+        if group is None or group.ended.is_set():
+            raise web.HTTPNotFound(text='no such group')
+        if not group.check_user(user):
+            raise web.HTTPForbidden(text='user is not in group')
+    else:
+        request.app.drainer.check()  # groups created before draining still fill up and run
+
     pc = RTCPeerConnection()
     pc_id = 'PeerConnection(%s)' % uuid.uuid4()
     pcs[pc_id] = pc
+    if group is not None:
+        group.pcs.add(pc)
+    # quality of group calls goes to the group's webhook, single calls are logged
+    room = group.uid if group is not None else pc_id
+    request.app.stats.add(room, pc)
+    taps = list()  # (sink, tap stream) reading single call audio into tap
     index = len(traks.keys())
 
     def log_info(msg, *args):
@@ -104,21 +199,70 @@ async def offer(request):
         log_info('ICE connection state is %s', pc.iceConnectionState)
         if pc.iceConnectionState == 'failed':
             await pc.close()
-            pcs.pop(pc_id)
+        elif pc.iceConnectionState == 'closed':
+            pcs.pop(pc_id, None)
+            request.app.stats.remove(pc)
+            if group is None:
+                for sink, tap in taps:
+                    await sink.stop()
+                    tap.close()
+                log_info('Call quality %s', json.dumps(request.app.stats.pop_room(room)))
+            else:
+                await group.remove_pc(pc)
+                if group.ended.is_set():
+                    request.app.groups.pop(group.uid, None)
 
     @pc.on('datachannel')
     def on_datachannel(channel):
+        control = protocol.MessageBatcher(channel)
+
         @channel.on('message')
-        def on_message(message):
-            if message == "END_CALL":
-                channel.send('pong' + message[4:])  # recieve message END_CALL for properly call ending by button
+        async def on_message(message):
+            if isinstance(message, bytes):
+                try:
+                    messages = protocol.decode(message)
+                except protocol.ProtocolError:
+                    return
+            else:
+                messages = protocol.decode_legacy(message)
+            for msg_type, value in messages:
+                if msg_type == protocol.MSG_PING:
+                    control.send(protocol.MSG_PONG, value)
+                elif msg_type == protocol.MSG_MUTE:
+                    if group is not None:
+                        kind = 'audio' if value['kind'] == protocol.KIND_AUDIO else 'video'
+                        group.mute(user, kind, value['muted'])
+                elif msg_type == protocol.MSG_END_CALL:
+                    # recieve END_CALL for properly call ending by button
+                    log_info('Call ended, reason %s', value)
+                    if isinstance(message, bytes):
+                        control.send(protocol.MSG_END_CALL, value)  # acknowledge with same reason
+                        control.flush()
+                    else:
+                        channel.send('pong' + message[4:])
+                    if group is not None:
+                        await group.end_call()  # ends call for every user
+                    else:
+                        await pc.close()
+                    return
 
     @pc.on('track')
     async def on_track(track):
         log_info('Track %s received', track.kind)
-        if track.kind == 'video':
+        if group is not None:
+            await group.add_track(user, track)
+        elif track.kind == 'video':
             traks[pc_id] = track
             events[0 if index else 1].set()
+        elif request.app.tap is not None:
+            # single calls have no mixer, a blackhole keeps tapped audio flowing
+            tap = request.app.tap.stream(pc_id)
+            tapped = ReSampledAudioStreamTrack(track, room, ProcessingChain(), tap=tap)
+            tapped.subscribe()
+            sink = MediaBlackhole()
+            sink.addTrack(tapped)
+            taps.append((sink, tap))
+            await sink.start()
         # if track.kind == 'audio':
         #     recorder.addTrack(track)
 
@@ -137,10 +281,16 @@ async def offer(request):
     #     elif t.kind == 'video':
     #         pc.addTrack(VideoStreamTrack())
 
-    await events[index].wait()
-    for k, t in traks.items():
-        if k != pc_id:
+    if group is not None:
+        await group.full.wait()
+        for t in group.get_tracks(user):
             pc.addTrack(t)
+            t.subscribe()
+    else:
+        await events[index].wait()
+        for k, t in traks.items():
+            if k != pc_id:
+                pc.addTrack(t)
 
     # send answer
     answer = await pc.createAnswer()
@@ -154,10 +304,61 @@ async def offer(request):
         }))
 
 
+@admin_only
+async def admin_profiler(request):
+    if request.method == 'POST':
+        params = await request.json()
+        if params.get('reset'):
+            profiler.reset()
+        if params.get('enabled'):
+            profiler.start()
+        elif 'enabled' in params:
+            profiler.stop()
+    return web.Response(
+        content_type='application/json',
+        text=json.dumps(profiler.report()))
+
+
+@admin_only
+async def admin_profiler_folded(request):
+    return web.Response(content_type='text/plain', text=profiler.folded())
+
+
+@admin_only
+async def admin_drain(request):
+    params = await request.json() if request.can_read_body else {}
+    request.app.drainer.start(params.get('timeout'))
+    active = [uid for uid, g in request.app.groups.items() if not g.ended.is_set()]
+    return web.Response(
+        content_type='application/json',
+        text=json.dumps({'draining': True,
+                         'remaining': request.app.drainer.remaining(),
+                         'calls': len(pcs),
+                         'groups': active}))
+
+
+async def on_startup(app):
+    app.stats.start()
+    if app.tap is not None:
+        await app.tap.start()
+
+
 async def on_shutdown(app):
+    # let running calls finish until drain deadline, then finalize recordings
+    app.drainer.start()
+    await app.drainer.wait(dict(
+        (pc, wait_until(lambda pc=pc: pc.iceConnectionState in ('closed', 'failed')))
+        for pc in list(pcs.values())))
+    groups = [g for g in app.groups.values() if not g.ended.is_set()]
+    await asyncio.gather(*[g.end_call() for g in groups])
+    await app.stats.stop()
+    if app.tap is not None:
+        await app.tap.stop()
     coros = [pc.close() for pc in app.connections]
+    coros.extend(pc.close() for pc in list(pcs.values()))
     await asyncio.gather(*coros)
     app.connections.clear()
+    pcs.clear()
 
 
 if __name__ == '__main__':
@@ -167,7 +368,12 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=8080,
                         help='Port for HTTP server (default: 8080)')
     parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--admin-token', help='Token for /admin routes (default: loopback clients only)')
     parser.add_argument('--write-audio', help='Write received audio to a file')
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds running calls get to finish on shutdown (default: %d)' % DEFAULT_TIMEOUT)
+    parser.add_argument('--tap-socket', help='Unix socket streaming participant audio to local consumers')
+    parser.add_argument('--webhook', help='URL receiving call summaries of ended groups')
     args = parser.parse_args()
 
     if args.verbose:
@@ -182,11 +388,22 @@ if __name__ == '__main__':
         ssl_context = None
 
     app = web.Application()
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     app.router.add_get('/', index)
     app.router.add_get('/client.js', javascript)
     app.router.add_post('/offer', offer)
+    app.router.add_view('/create_group', CreateGroup)
+    app.router.add_get('/admin/profiler', admin_profiler)
+    app.router.add_post('/admin/profiler', admin_profiler)
+    app.router.add_get('/admin/profiler/folded', admin_profiler_folded)
+    app.router.add_post('/admin/drain', admin_drain)
     app.groups = dict()
+    app.webhook = args.webhook
+    app.drainer = Drainer(args.drain_timeout)
+    app.admin_token = args.admin_token
+    app.stats = StatsCollector()
+    app.tap = AudioTap(args.tap_socket) if args.tap_socket else None
     app.connections = list()
     web.run_app(app, access_log=None, port=args.port, ssl_context=ssl_context)
 
@@ -2,23 +2,78 @@ from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.mediastreams import MediaStreamTrack, AudioStreamTrack, VideoStreamTrack
 import json
 import numpy as np
-from av import VideoFrame, AudioFrame, AudioResampler
-from aiortc.contrib.media import MediaPlayer, MediaStreamError, MediaBlackhole
+from av import VideoFrame, AudioFrame, AudioFifo, AudioResampler
+from aiortc.contrib.media import MediaPlayer, MediaStreamError
 import os
-from asyncio import gather, wait, sleep, ensure_future, wait_for, Future
-import fractions
+from asyncio import gather, wait, sleep, ensure_future, wait_for, Future, get_event_loop
+from collections import deque
 import time
+import protocol
+from profiler import profiler
+from pipeline import DEFAULT_CONFIG, VIDEO_CLOCK_RATE, VIDEO_TIME_BASE
+from pool import AudioFramePool, VideoFramePool, Yuv420Converter, audio_view, video_view
+from processing import ProcessingChain, SoftLimiter, INT16_SCALE, to_int16
 
 ROOT = os.path.dirname(__file__)
 
 
-class MulticastStreamTrack(MediaStreamTrack):  # base class for streams multiple recived
-    def __init__(self, track):
+class LazySourceMixin(object):
+    """Subscription counting for tracks wrapping a source.
+
+    While nobody subscribed the wrapper does no work. With `drain_idle`
+    remote sources are still read and frames dropped unprocessed, as aiortc
+    queues received frames until they are read. Subscribers (mixers, senders,
+    recorders) are the only readers otherwise, two readers of one source would
+    split its frames. Pausing only marks the track, mixers stop reading a
+    paused track by unsubscribing from it.
+    """
+
+    def init_lazy(self, drain_idle):
+        self.subscribers = 0
+        self.paused = False
+        self.drain_idle = drain_idle
+        self.idle_task = None
+        self.update_idle()
+
+    def subscribe(self):
+        self.subscribers += 1
+        self.update_idle()
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        self.update_idle()
+
+    def pause(self, paused):
+        self.paused = paused
+
+    @property
+    def idle(self):
+        return not self.subscribers
+
+    def update_idle(self):
+        if self.idle:
+            if self.drain_idle and self.idle_task is None:
+                self.idle_task = ensure_future(self.run_idle())
+        elif self.idle_task is not None:
+            self.idle_task.cancel()
+            self.idle_task = None
+
+    async def run_idle(self):
+        try:
+            while True:
+                await self._track.recv()
+        except MediaStreamError:
+            pass
+
+
+class MulticastStreamTrack(LazySourceMixin, MediaStreamTrack):  # base class for streams multiple recived
+    def __init__(self, track, drain_idle=False):
         super().__init__()
         self._track = track
         self.kind = track.kind
         self.recv_future = None
         self.futures = list()
+        self.init_lazy(drain_idle)
 
     @property
     def id(self):
@@ -32,10 +87,16 @@ class MulticastStreamTrack(MediaStreamTrack):  # base class for streams multiple
         self._track.stop()
 
     def resolve(self, future):
-        frame = future.result()
-        for fut in self.futures:
-            fut.set_result(frame)
-        self.futures = list()
+        futures, self.futures = self.futures, list()
+        if future.cancelled():
+            exc = MediaStreamError()  # source read cancelled, e.g. on shutdown
+        else:
+            exc = future.exception()
+        for fut in futures:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(future.result())
 
     def recv(self):
         if self.recv_future is None or self.recv_future.done():
@@ -47,15 +108,40 @@ class MulticastStreamTrack(MediaStreamTrack):  # base class for streams multiple
 
 
 class MuxStreamTrack(MediaStreamTrack):
-    def __init__(self):
+    stage = 'mux'
+
+    def __init__(self, room=None, config=None):
         super().__init__()  # don't forget this!
         self._tracks = set()
+        self.skipped = set()  # paused tracks this mixer unsubscribed from
+        self.room = room
+        self.config = config or DEFAULT_CONFIG
 
     def add_track(self, track):
+        if track in self._tracks:
+            return  # adding again must not leave a subscription behind
         self._tracks.add(track)
+        if isinstance(track, LazySourceMixin):
+            track.subscribe()
 
     def remove_track(self, track):
         self._tracks.remove(track)
+        if track in self.skipped:
+            self.skipped.discard(track)
+        elif isinstance(track, LazySourceMixin):
+            track.unsubscribe()
+
+    def update_paused(self):
+        # paused tracks are left to their other subscribers, or drained when there are none
+        for track in self._tracks:
+            if not isinstance(track, LazySourceMixin):
+                continue
+            if track.paused and track not in self.skipped:
+                self.skipped.add(track)
+                track.unsubscribe()
+            elif not track.paused and track in self.skipped:
+                self.skipped.discard(track)
+                track.subscribe()
 
     async def recv(self):
         dead = set()
@@ -64,8 +150,18 @@ class MuxStreamTrack(MediaStreamTrack):
                 dead.add(track)
         for track in dead:
             self.remove_track(track)
-        frames = await gather(*[track.recv() for track in self._tracks],
+        self.update_paused()
+        tracks = [track for track in self._tracks if track not in self.skipped]
+        if not tracks:
+            await sleep(self.config.frame_duration)  # keep pace while there is nothing to mix
+        frames = await gather(*[track.recv() for track in tracks],
                               return_exceptions=True)
+        if profiler.enabled:
+            start = profiler.begin(self.room, self.stage)
+            try:
+                return self.process_frames(frames)
+            finally:
+                profiler.end(start)
         return self.process_frames(frames)
 
     def process_frames(self, frames):
@@ -74,60 +170,188 @@ class MuxStreamTrack(MediaStreamTrack):
 
 class MuxVideoStreamTrack(MuxStreamTrack):
     kind = 'video'
+    stage = 'video'
 
-    # def __init__(self, width, height):
-    #     super().__init__()
-    #     self.width = width
-    #     self.height = height
+    def __init__(self, room=None, config=None):
+        super().__init__(room, config)
+        self.frames = None  # VideoFramePool sized for current track count
+        self.converter = Yuv420Converter(self.config.width, self.config.height)
+        self.pts = 0
 
     def process_frames(self, frames):
-        ars = list()
-        for frame in frames:
-            frame = frame.reformat(width=640, height=360)
-            ar = frame.to_ndarray(format="rgb24")
-            ars.append(ar)
-        try:
-            res = np.hstack(tuple(ars))
-        except Exception as e:
-            print(e)
-        new_frame = VideoFrame.from_ndarray(res, format="rgb24")
-        new_frame.pts = frame.pts
+        width, height = self.config.width, self.config.height
+        frames = [frame for frame in frames if isinstance(frame, VideoFrame)]
+        if self.frames is None or self.frames.width != width * max(len(frames), 1):
+            self.frames = VideoFramePool(width * max(len(frames), 1), height)
+        slot = self.frames.acquire()
+        new_frame = slot.frame
+        if not frames:  # black frame while nobody is shown
+            slot.array.fill(0)
+            new_frame.pts = self.pts
+            new_frame.time_base = VIDEO_TIME_BASE
+            self.pts += int(self.config.frame_duration * VIDEO_CLOCK_RATE)
+            return new_frame
+        for i, frame in enumerate(frames):
+            out = slot.array[:, i * width:(i + 1) * width]
+            if self.converter.matches(frame):
+                self.converter.convert(frame, out)
+                continue
+            if frame.format.name != 'rgb24' or frame.width != width or frame.height != height:
+                frame = frame.reformat(width=width, height=height, format="rgb24")
+            out[...] = video_view(frame, width, height)
+        new_frame.pts = self.pts = frame.pts
         new_frame.time_base = frame.time_base
         return new_frame
 
 
-class ReSampledAudioStreamTrack(AudioStreamTrack):
-    def __init__(self, track):
+class ReSampledAudioStreamTrack(LazySourceMixin, AudioStreamTrack):
+    def __init__(self, track, room=None, processor=None, config=None, drain_idle=False, tap=None):
         super().__init__()
         self._track = track
+        self.room = room
+        self.processor = processor  # ProcessingChain for resampled s16 frames
+        self.config = config or DEFAULT_CONFIG
         self.recv_future = None
         self.futures = list()
-        self.re_sampler = AudioResampler(
-                                        format='s16',
-                                        layout='mono',
-                                        rate=32000)
+        self.re_sampler = None  # created on first frame not in pipeline format
+        self.fifo = None  # re-chunks resampled audio into config.samples long frames
+        self.ready = deque()  # full frames left over from one resampled input frame
+        self.pts = None
+        self.frames = None  # AudioFramePool for processed frames
+        self.tap = tap  # TapStream getting every frame this track produces
+        self.init_lazy(drain_idle)
+
+    @property
+    def readyState(self):
+        # ends with its source, so mixers drop it instead of reading errors every tick
+        if super().readyState == 'ended':
+            return 'ended'
+        return self._track.readyState
+
+    def resample(self, frame):
+        """List of config.samples long frames in pipeline format, empty while more input is needed."""
+        config = self.config
+        matches = config.matches(frame)
+        if matches and frame.samples == config.samples and not (self.fifo and self.fifo.samples):
+            return [frame]
+        if matches:
+            frames = [frame]
+        else:
+            if self.re_sampler is None:
+                self.re_sampler = AudioResampler(
+                                                format=config.format,
+                                                layout=config.layout,
+                                                rate=config.rate)
+            frames = self.re_sampler.resample(frame)
+            if not isinstance(frames, list):  # older av returns single frame or None
+                frames = [frames] if frames is not None else []
+        if self.fifo is None:
+            self.fifo = AudioFifo()
+        for fr in frames:
+            if self.pts is None:
+                self.pts = fr.pts or 0
+            fr.pts = None  # timestamps are counted here, fifo must not check them
+            self.fifo.write(fr)
+        result = list()
+        while self.fifo.samples >= config.samples:
+            fr = self.fifo.read(config.samples)
+            fr.pts = self.pts
+            fr.time_base = config.time_base
+            fr.sample_rate = config.rate
+            self.pts += config.samples
+            result.append(fr)
+        return result
+
+    def read(self):
+        if self.ready:
+            # deliver on next loop iteration, so every subscriber of this tick shares the frame
+            self.recv_future = Future()
+            self.recv_future.add_done_callback(self.resolve_ready)
+            get_event_loop().call_soon(self.recv_future.set_result, self.ready.popleft())
+        else:
+            self.recv_future = ensure_future(self._track.recv())
+            self.recv_future.add_done_callback(self.resolve)
 
     def resolve(self, future):
-        frame = future.result()
-        frame = self.re_sampler.resample(frame)
-        for fut in self.futures:
+        if future.cancelled():
+            self.fail(MediaStreamError())  # source read cancelled, e.g. on shutdown
+            return
+        try:
+            frame = future.result()
+            if profiler.enabled:
+                start = profiler.begin(self.room, 'resample')
+                try:
+                    frames = self.resample(frame)
+                finally:
+                    profiler.end(start)
+            else:
+                frames = self.resample(frame)
+        except Exception as e:
+            self.fail(e)
+            return
+        if not frames:
+            self.read()  # subscribers keep waiting for a full frame
+            return
+        self.ready.extend(frames[1:])
+        self.deliver(frames[0])
+
+    def resolve_ready(self, future):
+        self.deliver(future.result())
+
+    def deliver(self, frame):
+        try:
+            if self.processor is not None and not self.paused:  # muted input is silence anyway
+                if profiler.enabled:
+                    start = profiler.begin(self.room, 'process')
+                    try:
+                        frame = self.process(frame)
+                    finally:
+                        profiler.end(start)
+                else:
+                    frame = self.process(frame)
+            if self.tap is not None:
+                self.tap.publish(frame)
+        except Exception as e:
+            self.fail(e)
+            return
+        futures, self.futures = self.futures, list()
+        for fut in futures:
             fut.set_result(frame)
-        self.futures = list()
+
+    def fail(self, exc):
+        futures, self.futures = self.futures, list()
+        for fut in futures:
+            fut.set_exception(exc)
+
+    def process(self, frame):
+        if self.frames is None:
+            self.frames = AudioFramePool(self.config)
+        slot = self.frames.acquire()
+        self.processor.process(audio_view(frame), slot.array)
+        new_frame = slot.frame
+        new_frame.pts = frame.pts
+        new_frame.time_base = frame.time_base
+        new_frame.sample_rate = frame.sample_rate
+        return new_frame
 
     def recv(self):
-        if self.recv_future is None or self.recv_future.done():
-            self.recv_future = ensure_future(self._track.recv())
-            self.recv_future.add_done_callback(self.resolve)
         fut = Future()
         self.futures.append(fut)
+        if self.recv_future is None or self.recv_future.done():
+            self.read()
         return fut
 
 
 class MuxAudioStreamTrack(MuxStreamTrack):
     kind = 'audio'
-
-    def __init__(self):
-        super().__init__()
+    stage = 'mix'
+
+    def __init__(self, room=None, limiter=None, config=None):
+        super().__init__(room, config)
+        self.limiter = limiter or SoftLimiter()
+        self.frames = AudioFramePool(self.config)
+        self.mix_buffer = None
+        self.scratch = None
         self.pts = 0
         self.last_time = time.time()
         self.pending = ()
@@ -151,35 +375,35 @@ class MuxAudioStreamTrack(MuxStreamTrack):
     #         frames = [frame]
     #     return self.process_frames(frames)
 
-    def add_track(self, track):
-        self._tracks.add(track)
-
     def process_frames(self, frames):
-        samples = int(0.020 * 32000)
-        res = None
-        mul = 0.9
-        # pts = 0
-        sz = 0
-        frame = None
+        config = self.config
+        slot = self.frames.acquire()
+        if self.mix_buffer is None:
+            self.mix_buffer = np.empty(slot.array.shape, dtype=np.float32)
+            self.scratch = np.empty_like(self.mix_buffer)
+        res = self.mix_buffer
+        mixed = False
         for fr in frames:
             if isinstance(fr, AudioFrame):
-                # pts = max(pts, fr.pts)
-                frame = fr
-                ar = fr.to_ndarray()
-                if res is not None:
-                    if ar.shape == sz:
-                        res += mul * ar
+                ar = audio_view(fr)
+                if ar.shape != res.shape:
+                    continue
+                if mixed:
+                    # convert first, adding int16 to float32 in place goes through casting buffers
+                    np.copyto(self.scratch, ar)
+                    res += self.scratch
                 else:
-                    res = mul * ar
-                    sz = ar.shape
-        np.clip(res, -32767, 32767, res)
-        res = res.astype('int16')
-        new_frame = AudioFrame.from_ndarray(res, format='s16', layout='mono')
+                    np.copyto(res, ar)
+                    mixed = True
+        if mixed:
+            res *= 1.0 / INT16_SCALE
+            to_int16(self.limiter.process(res), slot.array)
+        else:
+            slot.array.fill(0)
+        new_frame = slot.frame
         new_frame.pts = self.pts
         self.last_time = time.time()
-        self.pts += samples
-        new_frame.time_base = fractions.Fraction(1, 32000)
-        new_frame.sample_rate = 32000
+        self.pts += config.samples
         return new_frame
 
 
@@ -188,26 +412,30 @@ class ConnectionManager(object):
         self.pc = RTCPeerConnection()
         self.tracks = set()
         self.datachannel = None
+        self.control = None
+        self.binary = False  # peer speaks binary control protocol
+        self.muted = dict()
+        self.active_speaker = None
+        self.stats = None
+        self.end_reason = None
 
         @self.pc.on("datachannel")
         def on_datachannel(channel):
             self.datachannel = channel
+            self.control = protocol.MessageBatcher(channel)
 
             @channel.on("message")
             async def on_message(message):
-                try:
-                    data = json.loads(message)
-                except Exception:
-                    pass
+                if isinstance(message, bytes):
+                    self.binary = True
+                    try:
+                        messages = protocol.decode(message)
+                    except protocol.ProtocolError:
+                        return
                 else:
-                    if data.get('offer'):
-                        offer = data['offer']
-                        answer = await self.get_answer(offer['sdp'], offer['type'])
-                        channel.send(json.dumps({'answer': answer}))
-                    elif data.get('answer'):
-                        answer = data['answer']
-                        desc_answer = RTCSessionDescription(sdp=answer['sdp'], type=answer['type'])
-                        await self.pc.setRemoteDescription(desc_answer)
+                    messages = protocol.decode_legacy(message)
+                for msg_type, value in messages:
+                    await self.handle_message(msg_type, value)
 
         @self.pc.on("iceconnectionstatechange")
         async def on_iceconnectionstatechange():
@@ -217,9 +445,38 @@ class ConnectionManager(object):
         @self.pc.on("track")
         def on_track(track):
             if track.kind == 'audio':
-                self.tracks.add(ReSampledAudioStreamTrack(track))
+                self.tracks.add(ReSampledAudioStreamTrack(track, drain_idle=True))
             else:
-                self.tracks.add(track)
+                self.tracks.add(MulticastStreamTrack(track, drain_idle=True))
+
+    async def handle_message(self, msg_type, value):
+        if msg_type == protocol.MSG_OFFER:
+            answer = await self.get_answer(value['sdp'], value['type'])
+            self.send_description(protocol.MSG_ANSWER, answer)
+        elif msg_type == protocol.MSG_ANSWER:
+            desc_answer = RTCSessionDescription(sdp=value['sdp'], type=value['type'])
+            await self.pc.setRemoteDescription(desc_answer)
+        elif msg_type == protocol.MSG_PING:
+            self.control.send(protocol.MSG_PONG, value)
+        elif msg_type == protocol.MSG_MUTE:
+            self.muted[value['kind']] = value['muted']
+            kind = 'audio' if value['kind'] == protocol.KIND_AUDIO else 'video'
+            for track in self.tracks:
+                if track.kind == kind:
+                    track.pause(value['muted'])
+        elif msg_type == protocol.MSG_ACTIVE_SPEAKER:
+            self.active_speaker = value
+        elif msg_type == protocol.MSG_STATS:
+            self.stats = value
+        elif msg_type == protocol.MSG_END_CALL:
+            self.end_reason = value
+
+    def send_description(self, msg_type, description):
+        if self.binary:
+            self.control.send(msg_type, description)
+        else:
+            key = 'offer' if msg_type == protocol.MSG_OFFER else 'answer'
+            self.datachannel.send(json.dumps({key: description}))
 
     async def get_answer(self, sdp, type):
         request = RTCSessionDescription(sdp=sdp, type=type)
@@ -234,22 +491,25 @@ class ConnectionManager(object):
         await self.pc.setLocalDescription(request)
         request = {"sdp": self.pc.localDescription.sdp,
                    "type": self.pc.localDescription.type}
-        self.datachannel.send(json.dumps({'offer': request}))
+        self.send_description(protocol.MSG_OFFER, request)
 
     async def add_tracks(self, tracks):
         for tr in tracks:
             try:
                 self.pc.addTrack(tr)
             except Exception:
-                pass
+                continue
+            if isinstance(tr, LazySourceMixin):
+                tr.subscribe()  # sender reads it, stops idle draining
         await self.get_offer()
 
 
 class Connection(object):
-    def __init__(self):
+    def __init__(self, room=None, config=None):
+        self.room = room
+        self.config = config or DEFAULT_CONFIG
         self.pc = RTCPeerConnection()
         self.tracks = set()
-        self.bhs = set()
 
         @self.pc.on("iceconnectionstatechange")
         async def on_iceconnectionstatechange():
@@ -257,25 +517,20 @@ class Connection(object):
                 await self.pc.close()
 
         @self.pc.on("track")
-        async def on_track(track):
-            bh = MediaBlackhole()
+        def on_track(track):
+            # nothing is decoded further until a mixer or recorder subscribes
             if track.kind == 'audio':
-                rst = ReSampledAudioStreamTrack(track)
-                self.tracks.add(rst)
-                bh.addTrack(rst)
+                self.tracks.add(ReSampledAudioStreamTrack(
+                    track, self.room, ProcessingChain(), self.config, drain_idle=True))
             else:
-                self.tracks.add(track)
-                bh.addTrack(track)
-            await sleep(1)
-            await bh.start()
-            self.bhs.add(bh)
+                self.tracks.add(MulticastStreamTrack(track, drain_idle=True))
 
-        self.video = MuxVideoStreamTrack()
+        self.video = MuxVideoStreamTrack(room, self.config)
         self.video.add_track(VideoStreamTrack())
 
-        self.audio = MuxAudioStreamTrack()
+        self.audio = MuxAudioStreamTrack(room, config=self.config)
         player = MediaPlayer(os.path.join(ROOT, "Space Unicorn.mp3"))
-        self.audio.add_track(ReSampledAudioStreamTrack(player.audio))
+        self.audio.add_track(ReSampledAudioStreamTrack(player.audio, room, config=self.config))
 
         self.pc.addTrack(self.video)
         self.pc.addTrack(self.audio)
@@ -10,6 +10,50 @@ var pc = null;
 // data channel
 var dc = null, dcInterval = null;
 
+// binary control protocol, see protocol.py
+var PROTOCOL_VERSION = 1,
+    MSG_END_CALL = 6,
+    MSG_PING = 7,
+    MSG_PONG = 8,
+    END_REASON_BUTTON = 0;
+
+function encodeMessage(type, value) {
+    var buffer = new ArrayBuffer(2 + 3 + 4),
+        view = new DataView(buffer);
+    view.setUint8(0, PROTOCOL_VERSION);
+    view.setUint8(1, 1);
+    view.setUint8(2, type);
+    if (type === MSG_END_CALL) {
+        view.setUint16(3, 1);
+        view.setUint8(5, value);
+        return buffer.slice(0, 6);
+    }
+    view.setUint16(3, 4);
+    view.setUint32(5, value);
+    return buffer;
+}
+
+function decodeMessages(buffer) {
+    var view = new DataView(buffer), messages = [], offset = 2;
+    if (buffer.byteLength < 2 || view.getUint8(0) !== PROTOCOL_VERSION) {
+        return messages;
+    }
+    for (var i = 0; i < view.getUint8(1) && offset + 3 <= buffer.byteLength; i++) {
+        var type = view.getUint8(offset), size = view.getUint16(offset + 1);
+        offset += 3;
+        if (offset + size > buffer.byteLength) {
+            break;
+        }
+        if ((type === MSG_PING || type === MSG_PONG) && size === 4) {
+            messages.push({type: type, value: view.getUint32(offset)});
+        } else if (type === MSG_END_CALL && size === 1) {
+            messages.push({type: type, value: view.getUint8(offset)});
+        }
+        offset += size;
+    }
+    return messages;
+}
+
 function createPeerConnection() {
     var config = {
         sdpSemantics: 'unified-plan'
@@ -82,12 +126,19 @@ function negotiate() {
         }
 
         document.getElementById('offer-sdp').textContent = offer.sdp;
+        var body = {
+            sdp: offer.sdp,
+            type: offer.type,
+            video_transform: document.getElementById('video-transform').value
+        };
+        // join a group created with /create_group, e.g. /?uid=<group>&user=<user>
+        var query = new URLSearchParams(window.location.search);
+        if (query.get('uid')) {
+            body.uid = query.get('uid');
+            body.user = query.get('user');
+        }
         return fetch('/offer', {
-            body: JSON.stringify({
-                sdp: offer.sdp,
-                type: offer.type,
-                video_transform: document.getElementById('video-transform').value
-            }),
+            body: JSON.stringify(body),
             headers: {
                 'Content-Type': 'application/json'
             },
@@ -123,6 +174,7 @@ function start() {
         var parameters = JSON.parse(document.getElementById('datachannel-parameters').value);
 
         dc = pc.createDataChannel('chat', parameters);
+        dc.binaryType = 'arraybuffer';
         dc.onclose = function() {
             clearInterval(dcInterval);
             dataChannelLog.textContent += '- close\n';
@@ -130,12 +182,24 @@ function start() {
         dc.onopen = function() {
             dataChannelLog.textContent += '- open\n';
             dcInterval = setInterval(function() {
-                var message = 'ping ' + current_stamp();
-                dataChannelLog.textContent += '> ' + message + '\n';
-                dc.send(message);
+                var stamp = current_stamp();
+                dataChannelLog.textContent += '> ping ' + stamp + '\n';
+                dc.send(encodeMessage(MSG_PING, stamp));
             }, 1000);
         };
         dc.onmessage = function(evt) {
+            if (evt.data instanceof ArrayBuffer) {
+                decodeMessages(evt.data).forEach(function(message) {
+                    if (message.type === MSG_PONG) {
+                        dataChannelLog.textContent += '< pong ' + message.value + '\n';
+                        var elapsed_ms = current_stamp() - message.value;
+                        dataChannelLog.textContent += ' RTT ' + elapsed_ms + ' ms\n';
+                    } else if (message.type === MSG_END_CALL) {
+                        dataChannelLog.textContent += '< end call ' + message.value + '\n';
+                    }
+                });
+                return;
+            }
             dataChannelLog.textContent += '< ' + evt.data + '\n';
 
             if (evt.data.substring(0, 4) === 'pong') {
@@ -185,8 +249,11 @@ function start() {
 function stop() {
     document.getElementById('stop').style.display = 'none';
 
-    // close data channel
+    // close data channel, server ends the call on END_CALL
     if (dc) {
+        if (dc.readyState === 'open') {
+            dc.send(encodeMessage(MSG_END_CALL, END_REASON_BUTTON));
+        }
         dc.close();
     }
 
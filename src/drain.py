@@ -0,0 +1,52 @@
+import asyncio
+import math
+import time
+
+from aiohttp import web
+
+# Drain mode for rolling restarts: once started, new calls are rejected with
+# 503 and running calls get until the deadline to finish on their own.
+
+DEFAULT_TIMEOUT = 300
+POLL_INTERVAL = 0.5
+
+
+class Drainer(object):
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.draining = False
+        self.deadline = None
+
+    def start(self, timeout=None):
+        if self.draining:
+            return
+        self.draining = True
+        self.deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+
+    def remaining(self):
+        if self.deadline is None:
+            return self.timeout
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        """Reject new calls while draining."""
+        if self.draining:
+            raise web.HTTPServiceUnavailable(
+                headers={'Retry-After': str(int(math.ceil(self.remaining())))},
+                text='draining')
+
+    async def wait(self, waiters, timeout=None):
+        """Wait for {item: awaitable} until deadline, return items still running."""
+        if not waiters:
+            return []
+        tasks = dict((asyncio.ensure_future(aw), item) for item, aw in waiters.items())
+        done, pending = await asyncio.wait(
+            tasks.keys(), timeout=self.remaining() if timeout is None else timeout)
+        for task in pending:
+            task.cancel()
+        return [tasks[task] for task in pending]
+
+
+async def wait_until(predicate):
+    while not predicate():
+        await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import gc
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from av import AudioFrame, VideoFrame
+from aiortc.mediastreams import MediaStreamTrack
+
+from app import ConnectionGroup
+from classes import (ReSampledAudioStreamTrack, MulticastStreamTrack, MuxAudioStreamTrack,
+                     MuxVideoStreamTrack)
+from pipeline import DEFAULT_CONFIG, VIDEO_TIME_BASE
+import pool
+from pool import POOL_SIZE
+from processing import ProcessingChain
+from profiler import profiler
+
+# In process load test for the media graph.
+#
+# Fake tracks replace ICE/DTLS transports: producers generate frames in the
+# pipeline format and consumers pull frames the way RTCRtpSender and
+# MediaRecorder do, so rooms can be driven tick by tick without networking.
+# Group rooms go through app.py's ConnectionGroup, mix rooms give everybody
+# own mixer and compositor like test.py's /mix.
+
+VIDEO_PTS_STEP = 3000  # 30 fps
+# Allocated and freed within a tick is asyncio bookkeeping of consumers pulling
+# through gather (tasks, futures, handles), 1.5-2 KB per consumer. One audio
+# frame buffer per consumer (3840 bytes) already goes over the budget.
+TRANSIENT_BUDGET = 4096  # bytes per consumer and tick
+TRANSIENT_GROWTH = 1.1  # last quarter of ticks against first quarter
+# Media stages themselves only create numpy views and scalars, a frame sized
+# buffer (3840 bytes for 20 ms of 48 kHz stereo) goes over the budget.
+STAGE_BUDGET = 1024  # peak bytes per stage call
+# tracemalloc sees only the python object of an av frame, not its libav
+# buffers, so frames made by av calls inside stages are counted separately
+FRAME_MAKERS = frozenset(('reformat', 'resample', 'read', 'from_ndarray', 'from_image'))
+STAGES = (
+    (MuxAudioStreamTrack, 'process_frames'),
+    (MuxVideoStreamTrack, 'process_frames'),
+    (ReSampledAudioStreamTrack, 'resample'),
+    (ReSampledAudioStreamTrack, 'process'),
+)
+
+
+class FakeAudioTrack(MediaStreamTrack):
+    kind = 'audio'
+
+    def __init__(self, config=None, frequency=440):
+        super().__init__()
+        self.config = config or DEFAULT_CONFIG
+        self.pts = 0
+        samples = self.config.samples
+        t = np.arange(samples, dtype=np.float32) / self.config.rate
+        tone = (3000 * np.sin(2 * np.pi * frequency * t)).astype(np.int16)
+        self.data = np.repeat(tone, self.config.channels).reshape(1, -1)
+
+    async def recv(self):
+        await asyncio.sleep(0)  # yield like a network track, idle drainers would hog the loop
+        config = self.config
+        frame = AudioFrame.from_ndarray(self.data, format=config.format, layout=config.layout)
+        frame.sample_rate = config.rate
+        frame.time_base = config.time_base
+        frame.pts = self.pts
+        self.pts += config.samples
+        return frame
+
+
+class FakeVideoTrack(MediaStreamTrack):
+    kind = 'video'
+
+    def __init__(self, config=None):
+        super().__init__()
+        self.config = config or DEFAULT_CONFIG
+        self.pts = 0
+        self.planes = None  # mid gray plane contents, copied into every new frame
+
+    async def recv(self):
+        await asyncio.sleep(0)
+        # decoders hand out yuv420p, from_ndarray would add numpy temporaries to traces
+        frame = VideoFrame(self.config.width, self.config.height, 'yuv420p')
+        if self.planes is None:
+            self.planes = [b'\x80' * plane.buffer_size for plane in frame.planes]
+        for plane, data in zip(frame.planes, self.planes):
+            plane.update(data)
+        frame.time_base = VIDEO_TIME_BASE
+        frame.pts = self.pts
+        self.pts += VIDEO_PTS_STEP
+        return frame
+
+
+class FakeConsumer(object):
+    """Pulls frames from track like a sender or recorder would."""
+
+    def __init__(self, track):
+        self.track = track
+        self.frames = 0
+
+    async def pull(self):
+        await self.track.recv()
+        self.frames += 1
+
+
+class FakeRecorder(object):
+    """MediaRecorder stand in for ConnectionGroup, its tracks are pulled with the consumers."""
+
+    def __init__(self):
+        self.tracks = list()
+
+    def addTrack(self, track):
+        self.tracks.append(track)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class GroupRoom(object):
+    def __init__(self, uid, size, config, video=False):
+        self.uid = uid
+        self.config = config
+        self.video = video
+        self.users = ['user-%d' % i for i in range(size)]
+        self.recorder = FakeRecorder()
+        self.group = ConnectionGroup(uid, self.users, recorder=self.recorder)
+        self.consumers = list()
+
+    async def start(self):
+        for user in self.users:
+            await self.group.add_track(user, FakeAudioTrack(self.config))
+            if self.video:
+                await self.group.add_track(user, FakeVideoTrack(self.config))
+        await self.group.full.wait()
+        self.consumers = [FakeConsumer(track) for track in self.recorder.tracks]
+        for user in self.users:
+            for track in self.group.get_tracks(user):
+                track.subscribe()  # sender on user's connection, as in offer()
+                self.consumers.append(FakeConsumer(track))
+
+
+class FakeParticipant(object):
+    def __init__(self, room, config, video=False):
+        self.source = ReSampledAudioStreamTrack(FakeAudioTrack(config), room, ProcessingChain(), config)
+        self.mix = MuxAudioStreamTrack(room, config=config)
+        self.consumers = [FakeConsumer(self.mix)]
+        self.video_source = None
+        if video:
+            # shared by every other participant's compositor, as in Connection.on_track
+            self.video_source = MulticastStreamTrack(FakeVideoTrack(config))
+            self.video = MuxVideoStreamTrack(room, config)
+            self.consumers.append(FakeConsumer(self.video))
+
+
+class MixRoom(object):
+    def __init__(self, uid, size, config, video=False):
+        self.uid = uid
+        self.participants = [FakeParticipant(uid, config, video) for _ in range(size)]
+        for p in self.participants:
+            for other in self.participants:
+                if other is not p:
+                    p.mix.add_track(other.source)
+                    if video:
+                        p.video.add_track(other.video_source)
+        self.recording = MuxAudioStreamTrack(uid, config=config)
+        for p in self.participants:
+            self.recording.add_track(p.source)
+        self.recorder = FakeConsumer(self.recording)
+
+    async def start(self):
+        pass
+
+    @property
+    def consumers(self):
+        result = [self.recorder]
+        for p in self.participants:
+            result.extend(p.consumers)
+        return result
+
+
+ROOMS = {'group': GroupRoom, 'mix': MixRoom}
+
+
+async def make_rooms(topologies, rooms, size, config, video=False):
+    room_list = [ROOMS[topology]('%s-%d' % (topology, i), size, config, video)
+                 for topology in topologies for i in range(rooms)]
+    await asyncio.gather(*[room.start() for room in room_list])  # groups wait for their call to start
+    consumers = list()
+    for room in room_list:
+        consumers.extend(room.consumers)
+    return consumers
+
+
+class GcMonitor(object):
+    def __init__(self):
+        self.pauses = list()
+        self.start = None
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self.start = time.perf_counter()
+        elif self.start is not None:
+            self.pauses.append(time.perf_counter() - self.start)
+            self.start = None
+
+    def __enter__(self):
+        gc.callbacks.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        gc.callbacks.remove(self)
+
+
+def _av_owner(func):
+    owner = getattr(func, '__self__', None)
+    module = owner.__module__ if isinstance(owner, type) else type(owner).__module__
+    return module.split('.')[0] == 'av'
+
+
+class StageMeter(object):
+    """Traced memory peak of every call to media stages while active.
+
+    Stages are synchronous, so buffers they allocate and free again during a
+    call show up here even when they never overlap with other allocations.
+    With `count_frames` av calls making frames are counted instead, the
+    profile hook doing it allocates itself and would spoil the peaks.
+    """
+
+    def __init__(self, stages=STAGES, count_frames=False):
+        self.stages = stages
+        self.counting = count_frames
+        self.calls = dict()  # stage name -> [calls, peak bytes summed, av frames made]
+        self.originals = list()
+        self.current = None  # totals of stage running now
+
+    def wrap(self, cls, name):
+        method = getattr(cls, name)
+        totals = self.calls.setdefault('%s.%s' % (cls.__name__, name), [0, 0, 0])
+
+        def measured(*args, **kwargs):
+            outer, self.current = self.current, totals
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[0] += 1
+                totals[1] += tracemalloc.get_traced_memory()[1] - base
+                self.current = outer
+        setattr(cls, name, measured)
+        self.originals.append((cls, name, method))
+
+    def count_frames(self, frame, event, func):
+        if (event == 'c_call' and self.current is not None and
+                func.__name__ in FRAME_MAKERS and _av_owner(func)):
+            self.current[2] += 1
+
+    def __enter__(self):
+        for cls, name in self.stages:
+            self.wrap(cls, name)
+        if self.counting:
+            sys.setprofile(self.count_frames)
+        return self
+
+    def __exit__(self, *exc):
+        if self.counting:
+            sys.setprofile(None)
+        for cls, name, method in self.originals:
+            setattr(cls, name, method)
+        self.originals = list()
+
+    def bytes_per_call(self):
+        return dict((name, total / calls) for name, (calls, total, _) in self.calls.items() if calls)
+
+    def frames_per_call(self):
+        return dict((name, frames / calls) for name, (calls, _, frames) in self.calls.items() if calls)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+
+async def run(rooms, size, ticks, video=False, config=None, topology='group'):
+    config = config or DEFAULT_CONFIG
+    participants = rooms * size
+
+    # peak RSS, tracemalloc would miss libav frame buffers which are most of it
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    consumers = await make_rooms((topology,), rooms, size, config, video)
+    for _ in range(POOL_SIZE):  # first ticks create lazy state and fill pools
+        await asyncio.gather(*[c.pull() for c in consumers])
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tick_times = list()
+    with GcMonitor() as monitor:
+        for _ in range(ticks):
+            start = time.perf_counter()
+            await asyncio.gather(*[c.pull() for c in consumers])
+            tick_times.append(time.perf_counter() - start)
+
+    return {
+        'rooms': rooms,
+        'participants': participants,
+        'consumers': len(consumers),
+        'topology': topology,
+        'memory_per_participant_kb': (after - before) / participants,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'tick_avg_ms': sum(tick_times) / len(tick_times) * 1000 if tick_times else 0.0,
+        'tick_p50_ms': _percentile(tick_times, 50),
+        'tick_p99_ms': _percentile(tick_times, 99),
+        'tick_max_ms': max(tick_times) * 1000 if tick_times else 0.0,
+        'tick_budget_ms': config.frame_duration * 1000,
+        'gc_pauses': len(monitor.pauses),
+        'gc_total_ms': sum(monitor.pauses) * 1000,
+        'gc_max_ms': max(monitor.pauses) * 1000 if monitor.pauses else 0.0,
+    }
+
+
+async def alloc_check(rooms, size, ticks, config=None):
+    """Steady state allocation check, memory must not grow between ticks or within them."""
+    config = config or DEFAULT_CONFIG
+    consumers = await make_rooms(ROOMS, rooms, size, config, video=True)
+    tracemalloc.start()
+    for _ in range(POOL_SIZE * 2):  # fill pools and lazy buffers
+        await asyncio.gather(*[c.pull() for c in consumers])
+
+    gc.collect()
+    first = tracemalloc.take_snapshot()
+    replaced = pool.replaced_slots
+    transient = list()  # peak bytes above start of tick, per tick
+    for _ in range(ticks):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await asyncio.gather(*[c.pull() for c in consumers])
+        transient.append(tracemalloc.get_traced_memory()[1] - base)
+    gc.collect()
+    second = tracemalloc.take_snapshot()
+    with StageMeter() as meter:
+        for _ in range(ticks):
+            await asyncio.gather(*[c.pull() for c in consumers])
+    tracemalloc.stop()
+    with StageMeter(count_frames=True) as counter:
+        for _ in range(ticks):
+            await asyncio.gather(*[c.pull() for c in consumers])
+
+    filters = [tracemalloc.Filter(True, '*/%s.py' % name)
+               for name in ('classes', 'pool', 'processing', 'pipeline')]
+    diff = second.filter_traces(filters).compare_to(first.filter_traces(filters), 'lineno')
+    quarter = max(1, ticks // 4)
+    return {
+        'ticks': ticks,
+        'consumers': len(consumers),
+        'retained_blocks': sum(stat.count_diff for stat in diff),
+        'retained_bytes': sum(stat.size_diff for stat in diff),
+        'replaced_slots': pool.replaced_slots - replaced,
+        'transient_kb_per_tick': sum(transient) / ticks / 1024,
+        'transient_first_kb': sum(transient[:quarter]) / quarter / 1024,
+        'transient_last_kb': sum(transient[-quarter:]) / quarter / 1024,
+        'transient_per_consumer': sum(transient) / ticks / len(consumers),
+        'stage_bytes_per_call': meter.bytes_per_call(),
+        'stage_frames_per_call': counter.frames_per_call(),
+        'top': [str(stat) for stat in diff[:5] if stat.size_diff],
+    }
+
+
+def alloc_failures(result):
+    failures = list()
+    # replaced per track state (pts, timestamps) may show up once per consumer,
+    # anything above that grows with ticks
+    if result['retained_blocks'] > result['consumers']:
+        failures.append('media graph keeps %d new blocks' % result['retained_blocks'])
+    if result['replaced_slots']:
+        failures.append('%d pool slots still in use after a full ring' % result['replaced_slots'])
+    if result['transient_last_kb'] > result['transient_first_kb'] * TRANSIENT_GROWTH:
+        failures.append('per tick allocations grow from %.1f KB to %.1f KB' % (
+            result['transient_first_kb'], result['transient_last_kb']))
+    if result['transient_per_consumer'] > TRANSIENT_BUDGET:
+        failures.append('%d bytes allocated per consumer and tick, budget %d' % (
+            result['transient_per_consumer'], TRANSIENT_BUDGET))
+    for stage, size in result['stage_bytes_per_call'].items():
+        if size > STAGE_BUDGET:
+            failures.append('%s allocates %d bytes per call, budget %d' % (stage, size, STAGE_BUDGET))
+    for stage, frames in result['stage_frames_per_call'].items():
+        if frames:
+            failures.append('%s makes %.2f av frames per call' % (stage, frames))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Media graph load test with fake transports')
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--participants', type=int, default=2,
+                        help='Participants per room (default: 2)')
+    parser.add_argument('--ticks', type=int, default=250,
+                        help='Frames to push through every consumer (default: 250)')
+    parser.add_argument('--video', action='store_true', help='Also forward or composite video')
+    parser.add_argument('--topology', choices=sorted(ROOMS), default='group',
+                        help='group: app.py ConnectionGroup, mix: mixer per participant (default: group)')
+    parser.add_argument('--profile', action='store_true', help='Enable stage profiler')
+    parser.add_argument('--alloc-check', action='store_true',
+                        help='Fail if media graph allocations grow in steady state')
+    args = parser.parse_args()
+
+    async def main():
+        if args.alloc_check:
+            result = await alloc_check(args.rooms, args.participants, args.ticks)
+            result['failures'] = alloc_failures(result)
+            print(json.dumps(result, indent=2))
+            if result['failures']:
+                raise SystemExit(1)
+            return
+        if args.profile:
+            profiler.start()
+        result = await run(args.rooms, args.participants, args.ticks, args.video,
+                           topology=args.topology)
+        if args.profile:
+            result['profile'] = profiler.report()
+            profiler.stop()
+        print(json.dumps(result, indent=2))
+
+    asyncio.run(main())
@@ -4,20 +4,27 @@ import json
 import logging
 import os
 import ssl
-import uuid
 import uvloop
 import multiprocessing
+from multiprocessing import forkserver
 import queue
 
 from aiohttp import web
 
-from aiortc import RTCPeerConnection, RTCSessionDescription
-from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder
+import worker
+from admin import admin_only
+from drain import Drainer, DEFAULT_TIMEOUT, wait_until
 
 ROOT = os.path.dirname(__file__)
 
 logger = logging.getLogger("pc")
-pcs = set()
+pcs = dict()  # process -> its command queue
+STOP_GRACE = 5  # seconds child gets to finalize recording after stop command
+ANSWER_TIMEOUT = 30
+
+# workers fork from a server process that has heavy modules already imported
+mp = multiprocessing.get_context("forkserver")
+mp.set_forkserver_preload(worker.PRELOAD)
 
 
 async def index(request):
@@ -31,29 +38,30 @@ async def javascript(request):
 
 
 async def offer(request):
+    request.app.drainer.check()
     params = await request.json()
 
-    tx, rx = multiprocessing.Queue(), multiprocessing.Queue()
+    tx, rx = mp.Queue(), mp.Queue()
 
     tx.put_nowait(params)
 
-    p = multiprocessing.Process(
-        target=spawn_pc,
-        args=(tx, rx)
+    p = mp.Process(
+        target=worker.spawn_pc,
+        args=(tx, rx, request.app.write_audio, logging.getLogger().level)
     )
 
-    pcs.add(p)
+    pcs[p] = tx
 
     p.start()
 
-    # todo change
-    while True:
-        try:
-            result = rx.get_nowait()
-        except queue.Empty:
-            await asyncio.sleep(0.1)
-        else:
-            break
+    try:
+        result = await asyncio.get_event_loop().run_in_executor(
+            None, rx.get, True, ANSWER_TIMEOUT)
+    except queue.Empty:
+        p.terminate()
+        p.join()
+        pcs.pop(p, None)
+        raise web.HTTPGatewayTimeout(text="worker did not answer")
 
     asyncio.get_event_loop().create_task(wait_kill(rx, p))
 
@@ -73,90 +81,46 @@ async def wait_kill(rx, p):
                 await asyncio.sleep(0.1)
                 p.terminate()
                 p.join()
+                pcs.pop(p, None)
                 print("killed")
                 break
         except queue.Empty:
             await asyncio.sleep(0.1)
 
 
-async def on_shutdown(app):
-    # kill processes
-    [pc.terminate() for pc in pcs]
-    [pc.join() for pc in pcs]
-
-
-async def config_pc(tx, rx, end_event):
-    params = tx.get_nowait()
-    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
-
-    pc = RTCPeerConnection()
-    pc_id = "PeerConnection(%s)" % uuid.uuid4()
-
-    def log_info(msg, *args):
-        logger.info(pc_id + " " + msg, *args)
-
-    # prepare local media
-    player = MediaPlayer(os.path.join(ROOT, "Space Unicorn.mp3"))
-    if args.write_audio:
-        recorder = MediaRecorder(args.write_audio)
-    else:
-        recorder = MediaBlackhole()
-
-    @pc.on("datachannel")
-    def on_datachannel(channel):
-        @channel.on("message")
-        def on_message(message):
-            if isinstance(message, str) and message.startswith("ping"):
-                channel.send("pong" + message[4:])
-
-    @pc.on("iceconnectionstatechange")
-    async def on_iceconnectionstatechange():
-        log_info("ICE connection state is %s", pc.iceConnectionState)
-        if pc.iceConnectionState == "failed":
-            await pc.close()
-
-    @pc.on("track")
-    def on_track(track):
-        log_info("Track %s received", track.kind)
-
-        if track.kind == "audio":
-            pc.addTrack(player.audio)
-            recorder.addTrack(track)
-        elif track.kind == "video":
-            local_video = track
-            pc.addTrack(local_video)
-
-        @track.on("ended")
-        async def on_ended():
-            log_info("Track %s ended", track.kind)
-            await recorder.stop()
-            await pc.close()
-            rx.put_nowait("kill")
-            end_event.set()
-
-    # handle offer
-    await pc.setRemoteDescription(offer)
-    await recorder.start()
-
-    # send answer
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
-
-    rx.put_nowait({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type})
+@admin_only
+async def admin_drain(request):
+    # start draining ahead of shutdown, new offers get 503 from here on
+    params = await request.json() if request.can_read_body else {}
+    request.app.drainer.start(params.get("timeout"))
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"draining": True,
+                         "remaining": request.app.drainer.remaining(),
+                         "calls": len(pcs)}),
+    )
 
 
-async def waiter(event):
-    print('waiting for it ...')
-    await event.wait()
-    print('... got it!')
+async def on_startup(app):
+    # start forkserver before first offer arrives
+    await asyncio.get_event_loop().run_in_executor(None, forkserver.ensure_running)
 
 
-def spawn_pc(tx, rx):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    end_event = asyncio.Event()
-    loop.create_task(config_pc(tx, rx, end_event))
-    loop.run_until_complete(waiter(end_event))
+async def on_shutdown(app):
+    # let calls finish until drain deadline
+    app.drainer.start()
+    running = dict(pcs)
+    left = await app.drainer.wait(dict(
+        (p, wait_until(lambda p=p: not p.is_alive())) for p in running))
+    # ask the rest to stop recording and close
+    for p in left:
+        running[p].put_nowait("stop")
+    left = await app.drainer.wait(dict(
+        (p, wait_until(lambda p=p: not p.is_alive())) for p in left), STOP_GRACE)
+    # kill processes
+    [p.terminate() for p in left]
+    [p.join() for p in running]
+    pcs.clear()
 
 
 if __name__ == "__main__":
@@ -169,7 +133,12 @@ if __name__ == "__main__":
         "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
     )
     parser.add_argument("--verbose", "-v", action="count")
+    parser.add_argument("--admin-token", help="Token for /admin routes (default: loopback clients only)")
     parser.add_argument("--write-audio", help="Write received audio to a file")
+    parser.add_argument(
+        "--drain-timeout", type=float, default=DEFAULT_TIMEOUT,
+        help="Seconds running calls get to finish on shutdown (default: %d)" % DEFAULT_TIMEOUT
+    )
     args = parser.parse_args()
 
     if args.verbose:
@@ -186,8 +155,13 @@ if __name__ == "__main__":
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     app = web.Application()
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
+    app.drainer = Drainer(args.drain_timeout)
+    app.admin_token = args.admin_token
+    app.write_audio = args.write_audio
     app.router.add_get("/", index)
     app.router.add_get("/client.js", javascript)
     app.router.add_post("/offer", offer)
+    app.router.add_post("/admin/drain", admin_drain)
     web.run_app(app, access_log=None, port=args.port, ssl_context=ssl_context)
@@ -0,0 +1,84 @@
+import fractions
+
+# Media format used inside the service between decoders, mixers and encoders.
+#
+# aiortc decodes Opus to 48 kHz stereo s16 and its Opus encoder resamples
+# everything back to the same layout, so that is the default: incoming audio
+# passes through without resampling and outgoing mix goes straight to Opus.
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+
+class PipelineConfig(object):
+    __slots__ = ('rate', 'layout', 'format', 'frame_duration', 'width', 'height')
+
+    def __init__(self, rate=48000, layout='stereo', format='s16', frame_duration=0.020,
+                 width=640, height=360):
+        self.rate = rate
+        self.layout = layout
+        self.format = format
+        self.frame_duration = frame_duration
+        self.width = width
+        self.height = height
+
+    @property
+    def channels(self):
+        return 2 if self.layout == 'stereo' else 1
+
+    @property
+    def samples(self):
+        return int(self.frame_duration * self.rate)
+
+    @property
+    def time_base(self):
+        return fractions.Fraction(1, self.rate)
+
+    def matches(self, frame):
+        return (frame.sample_rate == self.rate and
+                frame.format.name == self.format and
+                frame.layout.name == self.layout)
+
+
+DEFAULT_CONFIG = PipelineConfig()
+LEGACY_CONFIG = PipelineConfig(rate=32000, layout='mono')
+
+
+if __name__ == '__main__':
+    import time
+    import numpy as np
+    from av import AudioFrame, AudioResampler
+
+    frames = 2000
+    opus = DEFAULT_CONFIG
+    noise = np.random.randint(-3000, 3000, size=(1, opus.samples * opus.channels), dtype=np.int16)
+
+    def make_frame():
+        frame = AudioFrame.from_ndarray(noise, format=opus.format, layout=opus.layout)
+        frame.sample_rate = opus.rate
+        return frame
+
+    def as_list(res):  # newer av returns list of frames from resample
+        return res if isinstance(res, list) else [res]
+
+    def bench(config):
+        # decoder output -> pipeline format -> encoder input, as done per participant
+        to_pipeline = AudioResampler(format=config.format, layout=config.layout, rate=config.rate)
+        to_encoder = AudioResampler(format=opus.format, layout=opus.layout, rate=opus.rate)
+        start = time.perf_counter()
+        for i in range(frames):
+            frame = make_frame()
+            frame.pts = i * opus.samples
+            out = [frame]
+            if not config.matches(frame):
+                out = as_list(to_pipeline.resample(frame))
+            for frame in out:
+                if not opus.matches(frame):
+                    to_encoder.resample(frame)
+        return time.perf_counter() - start
+
+    legacy = bench(LEGACY_CONFIG)
+    native = bench(DEFAULT_CONFIG)
+    print('%-24s %7.1f us per frame' % ('32 kHz mono pipeline', legacy / frames * 1e6))
+    print('%-24s %7.1f us per frame' % ('48 kHz stereo pipeline', native / frames * 1e6))
+    print('saved %.1f%% CPU on resampling path' % ((legacy - native) / legacy * 100))
@@ -0,0 +1,168 @@
+import sys
+
+import numpy as np
+from av import AudioFrame, VideoFrame
+
+# Recycled output frames for mixers, processors and compositors.
+#
+# Every pool keeps a ring of preallocated frames together with numpy views
+# on their planes, so writers fill frame memory directly instead of building
+# new arrays and frames every tick. A slot is handed out again only after the
+# whole ring went around. Encoders and recorders are done with a frame before
+# they ask for the next one, so that is plenty; consumers keeping frames (or
+# views on their planes) longer should copy. As a guard a slot whose frame is
+# still referenced outside the pool when its turn comes is left to its holder
+# and replaced with a fresh one, so a slow holder costs an allocation instead
+# of seeing its samples overwritten.
+
+POOL_SIZE = 4
+
+replaced_slots = 0  # slots retired because a holder kept their frame too long
+
+DTYPES = {
+    's16': np.int16,
+    's32': np.int32,
+    'flt': np.float32,
+}
+
+
+class FrameSlot(object):
+    __slots__ = ('frame', 'array', 'refs')
+
+    def __init__(self, frame, array):
+        self.frame = frame
+        self.array = array
+        self.refs = None  # frame refcount while only the pool holds it
+
+
+def _acquire(pool):
+    global replaced_slots
+    slot = pool.slots[pool.index]
+    refs = sys.getrefcount(slot.frame)
+    if slot.refs is None:
+        slot.refs = refs  # first use, nobody else has seen this frame yet
+    elif refs > slot.refs:
+        replaced_slots += 1
+        slot = pool.slots[pool.index] = pool.make_slot()
+        slot.refs = sys.getrefcount(slot.frame)
+    pool.index = (pool.index + 1) % len(pool.slots)
+    return slot
+
+
+class AudioFramePool(object):
+    __slots__ = ('config', 'slots', 'index')
+
+    def __init__(self, config, size=POOL_SIZE):
+        self.config = config
+        self.slots = [self.make_slot() for _ in range(size)]
+        self.index = 0
+
+    def make_slot(self):
+        config = self.config
+        frame = AudioFrame(format=config.format, layout=config.layout, samples=config.samples)
+        frame.sample_rate = config.rate
+        frame.time_base = config.time_base
+        count = config.samples * config.channels
+        array = np.frombuffer(frame.planes[0], dtype=DTYPES[config.format], count=count)
+        return FrameSlot(frame, array.reshape(1, count))
+
+    def acquire(self):
+        return _acquire(self)
+
+
+class VideoFramePool(object):
+    __slots__ = ('width', 'height', 'slots', 'index')
+
+    def __init__(self, width, height, size=POOL_SIZE):
+        self.width = width
+        self.height = height
+        self.slots = [self.make_slot() for _ in range(size)]
+        self.index = 0
+
+    def make_slot(self):
+        frame = VideoFrame(self.width, self.height, 'rgb24')
+        return FrameSlot(frame, video_view(frame, self.width, self.height))
+
+    def acquire(self):
+        return _acquire(self)
+
+
+def audio_view(frame):
+    """Zero copy (1, samples * channels) view on packed audio frame."""
+    dtype = DTYPES.get(frame.format.name)
+    if dtype is None or len(frame.planes) != 1:
+        return frame.to_ndarray()
+    count = frame.samples * len(frame.layout.channels)
+    return np.frombuffer(frame.planes[0], dtype=dtype, count=count).reshape(1, count)
+
+
+class Yuv420Converter(object):
+    """yuv420p to rgb24 into existing arrays, BT.601 limited range like swscale's default.
+
+    reformat() allocates a new frame every call, decoded video comes as
+    yuv420p, so compositors convert inputs of their own size with this and
+    leave scaling to libav.
+    """
+    __slots__ = ('width', 'height', 'luma', 'u', 'v', 'tmp', 'u_blocks', 'v_blocks')
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.luma = np.empty((height, width), dtype=np.float32)
+        self.u = np.empty_like(self.luma)
+        self.v = np.empty_like(self.luma)
+        self.tmp = np.empty_like(self.luma)
+        # 2x2 blocks sharing one chroma sample
+        self.u_blocks = self.u.reshape(height // 2, 2, width // 2, 2)
+        self.v_blocks = self.v.reshape(height // 2, 2, width // 2, 2)
+
+    def matches(self, frame):
+        return (frame.format.name == 'yuv420p' and
+                frame.width == self.width and frame.height == self.height)
+
+    def convert(self, frame, out):
+        """Write frame into (height, width, 3) uint8 array out."""
+        width, height = self.width, self.height
+        y, u, v = frame.planes
+        luma, tmp = self.luma, self.tmp
+        np.copyto(luma, plane_view(y, width, height), casting='unsafe')
+        luma -= 16
+        luma *= 1.164
+        np.copyto(self.u_blocks, plane_view(u, width // 2, height // 2)[:, None, :, None],
+                  casting='unsafe')
+        np.copyto(self.v_blocks, plane_view(v, width // 2, height // 2)[:, None, :, None],
+                  casting='unsafe')
+        self.u -= 128
+        self.v -= 128
+        np.multiply(self.u, 2.017, out=tmp)
+        tmp += luma
+        self.store(tmp, out[..., 2])
+        np.multiply(self.v, 1.596, out=tmp)
+        tmp += luma
+        self.store(tmp, out[..., 0])
+        self.u *= -0.392
+        self.v *= -0.813
+        np.add(self.u, self.v, out=tmp)
+        tmp += luma
+        self.store(tmp, out[..., 1])
+        return out
+
+    @staticmethod
+    def store(ar, out):
+        ar += 0.5  # round, uint8 cast truncates
+        np.minimum(ar, 255.0, out=ar)
+        np.maximum(ar, 0.0, out=ar)
+        np.copyto(out, ar, casting='unsafe')
+
+
+def plane_view(plane, width, height):
+    """Zero copy (height, width) view on 8 bit plane, skipping line padding."""
+    ar = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)
+    return ar[:height, :width]
+
+
+def video_view(frame, width, height):
+    """Zero copy (height, width, 3) view on rgb24 frame, skipping line padding."""
+    plane = frame.planes[0]
+    ar = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)
+    return ar[:height, :width * 3].reshape(height, width, 3)
@@ -0,0 +1,170 @@
+import numpy as np
+
+# Per input audio processing on resampled s16 frames.
+#
+# Stages work on float32 arrays normalized to [-1, 1] and keep their state
+# between frames, gain changes are ramped across the frame to avoid clicks.
+
+INT16_SCALE = 32767.0
+
+
+def _db_to_amp(db):
+    return 10.0 ** (db / 20.0)
+
+
+def _rms(ar):
+    return float(np.sqrt(np.dot(ar.ravel(), ar.ravel()) / ar.size)) if ar.size else 0.0
+
+
+class GainStage(object):
+    def __init__(self):
+        self.gain = 1.0
+        self.base = None  # 0..1 ramp across frame
+        self.ramp = None
+
+    def apply_gain(self, ar, target):
+        if target == self.gain:
+            if target != 1.0:
+                ar *= target
+            return ar
+        size = ar.shape[-1]
+        if self.base is None or self.base.size != size or self.base.ndim != ar.ndim:
+            # same dimensions as frame, broadcasting ramp over it would allocate
+            shape = (1,) * (ar.ndim - 1) + (size,)
+            self.base = np.linspace(0.0, 1.0, size, dtype=np.float32).reshape(shape)
+            self.ramp = np.empty_like(self.base)
+        np.multiply(self.base, target - self.gain, out=self.ramp)
+        self.ramp += self.gain
+        self.gain = target
+        ar *= self.ramp
+        return ar
+
+
+class NoiseGate(GainStage):
+    def __init__(self, open_db=-50.0, close_db=-56.0, floor_db=-30.0, hold_frames=10):
+        super().__init__()
+        self.open_level = _db_to_amp(open_db)
+        self.close_level = _db_to_amp(close_db)
+        self.floor = _db_to_amp(floor_db)  # attenuation of closed gate
+        self.hold_frames = hold_frames
+        self.hold = 0
+
+    def process(self, ar):
+        level = _rms(ar)
+        if level >= self.open_level:
+            self.hold = self.hold_frames
+        elif level < self.close_level and self.hold > 0:
+            self.hold -= 1
+        return self.apply_gain(ar, 1.0 if self.hold > 0 else self.floor)
+
+
+class AutomaticGainControl(GainStage):
+    def __init__(self, target_db=-20.0, max_gain_db=24.0, min_gain_db=-12.0,
+                 silence_db=-55.0, attack=0.3, release=0.02):
+        super().__init__()
+        self.target = _db_to_amp(target_db)
+        self.max_gain = _db_to_amp(max_gain_db)
+        self.min_gain = _db_to_amp(min_gain_db)
+        self.silence = _db_to_amp(silence_db)
+        self.attack = attack  # speed of gain reduction per frame
+        self.release = release  # speed of gain increase per frame
+
+    def process(self, ar):
+        level = _rms(ar)
+        target = self.gain
+        if level > self.silence:  # don't pump noise up in pauses
+            desired = min(max(self.target / level, self.min_gain), self.max_gain)
+            rate = self.attack if desired < self.gain else self.release
+            target = self.gain + (desired - self.gain) * rate
+        return self.apply_gain(ar, target)
+
+
+class SoftLimiter(object):
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self.knee = 1.0 - threshold
+        self.mag = None
+        self.flat = None  # flat view on mag, argmax on it doesn't allocate like max()
+        self.soft = None
+
+    def process(self, ar):
+        if self.mag is None or self.mag.shape != ar.shape:
+            self.mag = np.empty_like(ar)
+            self.flat = self.mag.reshape(-1)
+            self.soft = np.empty_like(ar)
+        mag = np.abs(ar, out=self.mag)
+        if self.flat[self.flat.argmax()] <= self.threshold:
+            return ar
+        # x - sign(x) * (e - knee * tanh(e / knee)) with e = max(|x| - t, 0) gives
+        # t + knee * tanh(...) above threshold and leaves samples below it alone
+        excess = mag
+        np.subtract(mag, self.threshold, out=excess)
+        np.maximum(excess, 0.0, out=excess)
+        soft = np.multiply(excess, 1.0 / self.knee, out=self.soft)
+        np.tanh(soft, out=soft)
+        soft *= self.knee
+        np.subtract(excess, soft, out=excess)
+        np.copysign(excess, ar, out=excess)
+        ar -= excess
+        return ar
+
+
+class ProcessingChain(object):
+    def __init__(self, stages=None):
+        self.stages = list(stages) if stages is not None else default_stages()
+        self.buffer = None
+
+    def process_float(self, ar):
+        for stage in self.stages:
+            ar = stage.process(ar)
+        return ar
+
+    def process(self, ar, out=None):
+        """Process int16 ndarray into out, or into new int16 ndarray."""
+        if self.buffer is None or self.buffer.shape != ar.shape:
+            self.buffer = np.empty(ar.shape, dtype=np.float32)
+        res = self.buffer
+        np.copyto(res, ar)
+        res *= 1.0 / INT16_SCALE
+        res = self.process_float(res)
+        return to_int16(res, out)
+
+
+def to_int16(ar, out=None):
+    ar *= INT16_SCALE
+    # ufuncs directly, np.clip goes through python wrappers allocating on every call
+    np.minimum(ar, INT16_SCALE, out=ar)
+    np.maximum(ar, -INT16_SCALE, out=ar)
+    if out is None:
+        return ar.astype(np.int16)
+    np.copyto(out, ar, casting='unsafe')
+    return out
+
+
+def default_stages():
+    return [NoiseGate(), AutomaticGainControl(), SoftLimiter()]
+
+
+if __name__ == '__main__':
+    import time
+    from pipeline import DEFAULT_CONFIG
+
+    config = DEFAULT_CONFIG
+    frames = 5000
+    t = np.arange(config.samples * frames, dtype=np.float32) / config.rate
+    signal = (0.05 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    # interleaved like audio_view() of a packed frame
+    signal = np.repeat(signal, config.channels).reshape(frames, 1, config.samples * config.channels)
+
+    chains = [('gate', [NoiseGate()]),
+              ('agc', [AutomaticGainControl()]),
+              ('limiter', [SoftLimiter()]),
+              ('full chain', default_stages())]
+    for name, stages in chains:
+        chain = ProcessingChain(stages)
+        start = time.perf_counter()
+        for frame in signal:
+            chain.process(frame)
+        elapsed = time.perf_counter() - start
+        print('%-12s %8.1f us per %d ms %s frame' % (
+            name, elapsed / frames * 1e6, config.frame_duration * 1000, config.layout))
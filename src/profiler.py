@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+
+# Runtime switchable profiler for media hot paths.
+#
+# Call sites check `profiler.enabled` before taking any timings, so disabled
+# profiler costs one attribute lookup per frame.
+
+SAMPLE_INTERVAL = 0.005
+WATCHDOG_INTERVAL = 0.05
+LAG_THRESHOLD = 0.1
+MAX_SLOW = 50
+MAX_STACK_DEPTH = 64
+
+
+class StageTimer(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_ms': self.total * 1000,
+                'avg_ms': self.total * 1000 / self.count if self.count else 0,
+                'max_ms': self.max * 1000}
+
+
+def _folded_stack(frame, prefix):
+    names = list()
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    names.extend(reversed(prefix))
+    return ';'.join(reversed(names))
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.stages = dict()  # (room, stage) -> StageTimer
+        self.samples = collections.Counter()  # folded stack -> count
+        self.slow = collections.deque(maxlen=MAX_SLOW)
+        self.current = None  # (room, stage) running on loop thread
+        self.loop = None
+        self.loop_thread = None
+        self.beat = 0.0
+        self.max_lag = 0.0
+        self.stalled = False
+        self.heartbeat = None
+        self.sampler = None
+
+    def start(self, loop=None):
+        if self.enabled:
+            return
+        self.loop = loop or asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.beat = time.perf_counter()
+        self.enabled = True
+        self.heartbeat = self.loop.create_task(self.run_heartbeat())
+        self.sampler = threading.Thread(target=self.run_sampler, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.current = None
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        self.sampler = None
+
+    def reset(self):
+        self.stages = dict()
+        self.samples = collections.Counter()
+        self.slow.clear()
+        self.max_lag = 0.0
+
+    def begin(self, room, stage):
+        self.current = (room, stage)
+        return time.perf_counter()
+
+    def end(self, start):
+        duration = time.perf_counter() - start
+        key = self.current
+        self.current = None
+        if key is None:
+            return
+        timer = self.stages.get(key)
+        if timer is None:
+            timer = self.stages[key] = StageTimer()
+        timer.add(duration)
+
+    async def run_heartbeat(self):
+        while self.enabled:
+            expected = time.perf_counter() + WATCHDOG_INTERVAL
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            now = time.perf_counter()
+            lag = now - expected
+            if lag > self.max_lag:
+                self.max_lag = lag
+            self.beat = now
+
+    def run_sampler(self):
+        me = self.sampler
+        while self.enabled and self.sampler is me:
+            time.sleep(SAMPLE_INTERVAL)
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            current = self.current
+            prefix = ('room %s' % current[0], current[1]) if current else ('loop',)
+            stack = _folded_stack(frame, prefix)
+            self.samples[stack] += 1
+            lag = time.perf_counter() - self.beat - WATCHDOG_INTERVAL
+            if lag > LAG_THRESHOLD:
+                if not self.stalled:
+                    self.stalled = True
+                    self.slow.append({'lag_ms': lag * 1000, 'time': time.time(),
+                                      'stage': current, 'stack': stack})
+                elif self.slow and lag * 1000 > self.slow[-1]['lag_ms']:
+                    self.slow[-1]['lag_ms'] = lag * 1000
+            else:
+                self.stalled = False
+
+    def report(self):
+        rooms = dict()
+        for (room, stage), timer in self.stages.items():
+            rooms.setdefault(str(room), dict())[stage] = timer.as_dict()
+        slow = sorted(self.slow, key=lambda s: s['lag_ms'], reverse=True)
+        return {'enabled': self.enabled,
+                'max_lag_ms': self.max_lag * 1000,
+                'rooms': rooms,
+                'slow_callbacks': slow}
+
+    def folded(self):
+        """Samples in folded stack format accepted by flamegraph.pl and speedscope."""
+        samples = dict(self.samples)  # sampler thread keeps adding stacks
+        return '\n'.join('%s %d' % (stack, count) for stack, count in samples.items())
+
+
+profiler = Profiler()
@@ -0,0 +1,225 @@
+import json
+import struct
+from asyncio import get_event_loop
+
+# Binary control protocol for data channels.
+#
+# Packet: version (u8), message count (u8), then messages.
+# Message: type (u8), payload length (u16), payload.
+# Several control messages queued in one loop tick go out as one packet.
+
+VERSION = 1
+
+MSG_OFFER = 1
+MSG_ANSWER = 2
+MSG_ACTIVE_SPEAKER = 3
+MSG_STATS = 4
+MSG_MUTE = 5
+MSG_END_CALL = 6
+MSG_PING = 7
+MSG_PONG = 8
+
+END_REASON_BUTTON = 0  # properly ended by button
+END_REASON_HANGUP = 1
+END_REASON_TIMEOUT = 2
+END_REASON_ERROR = 3
+END_REASON_SHUTDOWN = 4
+
+KIND_AUDIO = 0
+KIND_VIDEO = 1
+
+MAX_PACKET_SIZE = 16384  # keep packets below common SCTP message limits
+MAX_PACKET_MESSAGES = 255
+
+_packet_header = struct.Struct('!BB')
+_message_header = struct.Struct('!BH')
+_speaker = struct.Struct('!H')  # audio level, followed by utf-8 user id
+_stats = struct.Struct('!HHII')  # rtt ms, jitter ms, packets lost, bitrate kbps
+_mute = struct.Struct('!BB')  # kind, muted
+_end_call = struct.Struct('!B')  # reason
+_ping = struct.Struct('!I')  # sequence number
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _encode_description(value):
+    return value['sdp'].encode('utf-8')
+
+
+def _encode_speaker(value):
+    return _speaker.pack(value.get('level', 0)) + str(value['user']).encode('utf-8')
+
+
+def _clamp(value, limit):
+    return min(max(int(round(value)), 0), limit)
+
+
+def _encode_stats(value):
+    # browsers report fractional ms and can exceed field range on bad links
+    return _stats.pack(_clamp(value.get('rtt', 0), 0xffff),
+                       _clamp(value.get('jitter', 0), 0xffff),
+                       _clamp(value.get('lost', 0), 0xffffffff),
+                       _clamp(value.get('bitrate', 0), 0xffffffff))
+
+
+def _encode_mute(value):
+    return _mute.pack(value['kind'], bool(value['muted']))
+
+
+def _encode_end_call(value):
+    return _end_call.pack(value)
+
+
+def _encode_ping(value):
+    return _ping.pack(value)
+
+
+def _decode_offer(payload):
+    return {'sdp': str(payload, 'utf-8'), 'type': 'offer'}
+
+
+def _decode_answer(payload):
+    return {'sdp': str(payload, 'utf-8'), 'type': 'answer'}
+
+
+def _decode_speaker(payload):
+    level, = _speaker.unpack_from(payload)
+    user = str(payload[_speaker.size:], 'utf-8')
+    return {'user': user, 'level': level}
+
+
+def _decode_stats(payload):
+    rtt, jitter, lost, bitrate = _stats.unpack(payload)
+    return {'rtt': rtt, 'jitter': jitter, 'lost': lost, 'bitrate': bitrate}
+
+
+def _decode_mute(payload):
+    kind, muted = _mute.unpack(payload)
+    return {'kind': kind, 'muted': bool(muted)}
+
+
+def _decode_end_call(payload):
+    return _end_call.unpack(payload)[0]
+
+
+def _decode_ping(payload):
+    return _ping.unpack(payload)[0]
+
+
+ENCODERS = {
+    MSG_OFFER: _encode_description,
+    MSG_ANSWER: _encode_description,
+    MSG_ACTIVE_SPEAKER: _encode_speaker,
+    MSG_STATS: _encode_stats,
+    MSG_MUTE: _encode_mute,
+    MSG_END_CALL: _encode_end_call,
+    MSG_PING: _encode_ping,
+    MSG_PONG: _encode_ping,
+}
+
+DECODERS = {
+    MSG_OFFER: _decode_offer,
+    MSG_ANSWER: _decode_answer,
+    MSG_ACTIVE_SPEAKER: _decode_speaker,
+    MSG_STATS: _decode_stats,
+    MSG_MUTE: _decode_mute,
+    MSG_END_CALL: _decode_end_call,
+    MSG_PING: _decode_ping,
+    MSG_PONG: _decode_ping,
+}
+
+
+def encode_message(msg_type, value):
+    try:
+        payload = ENCODERS[msg_type](value)
+    except (struct.error, TypeError, ValueError) as e:
+        raise ProtocolError('bad value for message type %d: %s' % (msg_type, e))
+    if len(payload) > 0xffff:
+        raise ProtocolError('payload too large for message type %d' % msg_type)
+    return _message_header.pack(msg_type, len(payload)) + payload
+
+
+def encode(messages):
+    """Pack list of (type, value) pairs into one packet."""
+    encoded = [encode_message(t, v) for t, v in messages]
+    return _packet_header.pack(VERSION, len(encoded)) + b''.join(encoded)
+
+
+def decode(data):
+    """Unpack packet into list of (type, value) pairs, unknown types are skipped."""
+    if len(data) < _packet_header.size:
+        raise ProtocolError('packet too short')
+    version, count = _packet_header.unpack_from(data, 0)
+    if version != VERSION:
+        raise ProtocolError('unsupported protocol version %d' % version)
+    data = memoryview(data)
+    offset = _packet_header.size
+    end = len(data)
+    messages = list()
+    for _ in range(count):
+        if offset + _message_header.size > end:
+            raise ProtocolError('truncated message header')
+        msg_type, size = _message_header.unpack_from(data, offset)
+        offset += _message_header.size
+        if offset + size > end:
+            raise ProtocolError('truncated message payload')
+        decoder = DECODERS.get(msg_type)
+        if decoder is not None:
+            try:
+                # decoders only see their own payload, fixed size ones must match it exactly
+                messages.append((msg_type, decoder(data[offset:offset + size])))
+            except (struct.error, UnicodeDecodeError) as e:
+                raise ProtocolError(str(e))
+        offset += size
+    return messages
+
+
+def decode_legacy(message):
+    """Map old string/json messages to (type, value) pairs."""
+    if message == 'END_CALL':
+        return [(MSG_END_CALL, END_REASON_BUTTON)]
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return []
+    if not isinstance(data, dict):
+        return []
+    if data.get('offer'):
+        return [(MSG_OFFER, data['offer'])]
+    if data.get('answer'):
+        return [(MSG_ANSWER, data['answer'])]
+    return []
+
+
+class MessageBatcher(object):
+    """Collects control messages and sends them once per loop tick."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.pending = list()
+        self.size = _packet_header.size
+        self.handle = None
+
+    def send(self, msg_type, value):
+        message = encode_message(msg_type, value)
+        if (len(self.pending) >= MAX_PACKET_MESSAGES or
+                self.size + len(message) > MAX_PACKET_SIZE):
+            self.flush()
+        self.pending.append(message)
+        self.size += len(message)
+        if self.handle is None:
+            self.handle = get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.pending:
+            return
+        packet = _packet_header.pack(VERSION, len(self.pending)) + b''.join(self.pending)
+        self.pending = list()
+        self.size = _packet_header.size
+        if self.channel.readyState == 'open':
+            self.channel.send(packet)
@@ -11,11 +11,15 @@ from aiohttp import web
 
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder
+import protocol
+from admin import admin_only
+from drain import Drainer, DEFAULT_TIMEOUT, wait_until
 
 ROOT = os.path.dirname(__file__)
 
 logger = logging.getLogger("pc")
 pcs = set()
+recorders = dict()
 
 
 
@@ -30,6 +34,7 @@ async def javascript(request):
 
 
 async def offer(request):
+    request.app.drainer.check()
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
@@ -48,13 +53,33 @@ async def offer(request):
         recorder = MediaRecorder(args.write_audio)
     else:
         recorder = MediaBlackhole()
+    recorders[pc] = recorder
 
     @pc.on("datachannel")
     def on_datachannel(channel):
+        control = protocol.MessageBatcher(channel)
+
         @channel.on("message")
-        def on_message(message):
+        async def on_message(message):
             if isinstance(message, str) and message.startswith("ping"):
                 channel.send("pong" + message[4:])
+            elif isinstance(message, bytes):
+                try:
+                    messages = protocol.decode(message)
+                except protocol.ProtocolError:
+                    return
+                for msg_type, value in messages:
+                    if msg_type == protocol.MSG_PING:
+                        control.send(protocol.MSG_PONG, value)
+                    elif msg_type == protocol.MSG_END_CALL:
+                        log_info("Call ended, reason %s", value)
+                        control.send(protocol.MSG_END_CALL, value)  # acknowledge with same reason
+                        control.flush()
+                        await recorder.stop()
+                        await pc.close()
+                        pcs.discard(pc)
+                        recorders.pop(pc, None)
+                        return
 
     @pc.on("iceconnectionstatechange")
     async def on_iceconnectionstatechange():
@@ -62,6 +87,7 @@ async def offer(request):
         if pc.iceConnectionState == "failed":
             await pc.close()
             pcs.discard(pc)
+            recorders.pop(pc, None)
 
     @pc.on("track")
     def on_track(track):
@@ -95,7 +121,27 @@ async def offer(request):
     )
 
 
+@admin_only
+async def admin_drain(request):
+    # start draining ahead of shutdown, new offers get 503 from here on
+    params = await request.json() if request.can_read_body else {}
+    request.app.drainer.start(params.get("timeout"))
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"draining": True,
+                         "remaining": request.app.drainer.remaining(),
+                         "calls": len(pcs)}),
+    )
+
+
 async def on_shutdown(app):
+    # wait for running calls until drain deadline, then finalize recordings
+    app.drainer.start()
+    await app.drainer.wait(dict(
+        (pc, wait_until(lambda pc=pc: pc.iceConnectionState in ("closed", "failed")))
+        for pc in pcs))
+    await asyncio.gather(*[recorder.stop() for recorder in recorders.values()])
+    recorders.clear()
     # close peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -112,7 +158,12 @@ if __name__ == "__main__":
         "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
     )
     parser.add_argument("--verbose", "-v", action="count")
+    parser.add_argument("--admin-token", help="Token for /admin routes (default: loopback clients only)")
     parser.add_argument("--write-audio", help="Write received audio to a file")
+    parser.add_argument(
+        "--drain-timeout", type=float, default=DEFAULT_TIMEOUT,
+        help="Seconds running calls get to finish on shutdown (default: %d)" % DEFAULT_TIMEOUT
+    )
     args = parser.parse_args()
 
     if args.verbose:
@@ -130,7 +181,10 @@ if __name__ == "__main__":
 
     app = web.Application()
     app.on_shutdown.append(on_shutdown)
+    app.drainer = Drainer(args.drain_timeout)
+    app.admin_token = args.admin_token
     app.router.add_get("/", index)
     app.router.add_get("/client.js", javascript)
     app.router.add_post("/offer", offer)
+    app.router.add_post("/admin/drain", admin_drain)
     web.run_app(app, access_log=None, port=args.port, ssl_context=ssl_context)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+# Network quality telemetry from RTCP statistics.
+#
+# Every peer is sampled once per round and samples are spread evenly over the
+# round, so getStats() calls never come in bursts. Values go to fixed size
+# ring buffers per room and a summary is built when the call ends.
+
+ROUND_INTERVAL = 10.0  # seconds between two samples of same peer
+RING_SIZE = 360  # one hour of samples at default interval
+CLOCK_RATES = {'audio': 48000, 'video': 90000}
+METRICS = ('jitter_ms', 'rtt_ms', 'loss', 'bitrate_kbps')
+
+logger = logging.getLogger('stats')
+
+
+class RingBuffer(object):
+    __slots__ = ('values', 'index', 'count')
+
+    def __init__(self, size=RING_SIZE):
+        self.values = np.zeros(size, dtype=np.float32)
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.values.size
+        if self.count < self.values.size:
+            self.count += 1
+
+    def summary(self):
+        if not self.count:
+            return None
+        values = self.values[:self.count]
+        return {'avg': float(values.mean()),
+                'p95': float(np.percentile(values, 95)),
+                'max': float(values.max())}
+
+
+class RoomStats(object):
+    __slots__ = ('rings', 'samples')
+
+    def __init__(self):
+        self.rings = dict((metric, RingBuffer()) for metric in METRICS)
+        self.samples = 0
+
+    def add(self, sample):
+        for metric, value in sample.items():
+            if value is not None:
+                self.rings[metric].append(value)
+        self.samples += 1
+
+    def summary(self):
+        result = dict((metric, ring.summary()) for metric, ring in self.rings.items())
+        result['samples'] = self.samples
+        return result
+
+
+class PeerState(object):
+    __slots__ = ('room', 'pc', 'bytes', 'time')
+
+    def __init__(self, room, pc):
+        self.room = room
+        self.pc = pc
+        self.bytes = None
+        self.time = None
+
+
+class StatsCollector(object):
+    def __init__(self, interval=ROUND_INTERVAL):
+        self.interval = interval
+        self.peers = dict()  # pc -> PeerState
+        self.rooms = dict()  # room -> RoomStats
+        self.task = None
+
+    def add(self, room, pc):
+        self.peers[pc] = PeerState(room, pc)
+        if room not in self.rooms:
+            self.rooms[room] = RoomStats()
+
+    def remove(self, pc):
+        self.peers.pop(pc, None)
+
+    def pop_room(self, room):
+        """Summary for finished room, drops its buffers."""
+        for pc in [pc for pc, peer in self.peers.items() if peer.room == room]:
+            self.remove(pc)
+        stats = self.rooms.pop(room, None)
+        return stats.summary() if stats is not None else None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            peers = list(self.peers.values())
+            if not peers:
+                await asyncio.sleep(self.interval)
+                continue
+            step = self.interval / len(peers)
+            for peer in peers:
+                started = time.monotonic()
+                if peer.pc in self.peers:
+                    try:
+                        await self.sample(peer)
+                    except Exception:
+                        logger.exception('getStats failed')
+                await asyncio.sleep(max(0.0, step - (time.monotonic() - started)))
+
+    async def sample(self, peer):
+        if peer.pc.iceConnectionState not in ('connected', 'completed'):
+            return
+        report = await peer.pc.getStats()
+        jitter = rtt = loss = None
+        transferred = 0
+        for stat in report.values():
+            if stat.type == 'inbound-rtp':
+                rate = CLOCK_RATES.get(stat.kind, CLOCK_RATES['audio'])
+                jitter = max(jitter or 0.0, stat.jitter * 1000.0 / rate)
+            elif stat.type == 'remote-inbound-rtp':
+                if stat.roundTripTime is not None:
+                    rtt = max(rtt or 0.0, stat.roundTripTime * 1000.0)
+                loss = max(loss or 0.0, stat.fractionLost / 256.0)
+            elif stat.type == 'transport':
+                transferred += stat.bytesReceived + stat.bytesSent
+        now = time.monotonic()
+        bitrate = None
+        if peer.bytes is not None and now > peer.time and transferred >= peer.bytes:
+            bitrate = (transferred - peer.bytes) * 8 / (now - peer.time) / 1000.0
+        peer.bytes, peer.time = transferred, now
+        stats = self.rooms.get(peer.room)
+        if stats is not None:
+            stats.add({'jitter_ms': jitter, 'rtt_ms': rtt, 'loss': loss,
+                       'bitrate_kbps': bitrate})
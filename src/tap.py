@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import stat
+import struct
+
+# Streaming tap: per participant PCM over a local unix socket.
+#
+# Every message is a header followed by payload:
+#   type (u8), channels (u8), stream id (u16), sample rate (u32),
+#   pts (u64), payload length (u32)
+# STREAM_START payload is utf-8 label of stream, PCM payload is packed s16.
+#
+# Publishing never waits: every frame is copied once into a message shared by
+# all consumers (transports may buffer it while the frame's pool slot is
+# rewritten), and while a consumer's transport buffer is above the high water
+# mark its frames are dropped (or the consumer is disconnected).
+
+MSG_STREAM_START = 1
+MSG_PCM = 2
+MSG_STREAM_END = 3
+
+HIGH_WATER = 256 * 1024
+DROP_NEWEST = 'newest'
+DROP_DISCONNECT = 'disconnect'
+BYTES_PER_SAMPLE = {'s16': 2, 's32': 4, 'flt': 4}
+
+_header = struct.Struct('!BBHIQI')
+
+logger = logging.getLogger('tap')
+
+
+class TapProtocol(asyncio.Protocol):
+    def __init__(self, tap):
+        self.tap = tap
+        self.transport = None
+        self.paused = False
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.tap.high_water)
+        self.tap.consumers.add(self)
+        for stream in self.tap.streams.values():
+            self.write(stream.start_message())
+
+    def connection_lost(self, exc):
+        self.tap.consumers.discard(self)
+        if self.dropped:
+            logger.info('Tap consumer left, %d frames dropped', self.dropped)
+
+    def pause_writing(self):
+        self.paused = True
+        if self.tap.drop == DROP_DISCONNECT:
+            self.transport.abort()
+
+    def resume_writing(self):
+        self.paused = False
+
+    def write(self, *chunks):
+        if self.paused:
+            self.dropped += 1
+            return
+        self.transport.writelines(chunks)
+
+
+class TapStream(object):
+    __slots__ = ('tap', 'id', 'label')
+
+    def __init__(self, tap, stream_id, label):
+        self.tap = tap
+        self.id = stream_id
+        self.label = label
+
+    def start_message(self):
+        label = self.label.encode('utf-8')
+        return _header.pack(MSG_STREAM_START, 0, self.id, 0, 0, len(label)) + label
+
+    def publish(self, frame):
+        consumers = self.tap.consumers
+        if not consumers:
+            return
+        channels = len(frame.layout.channels)
+        size = frame.samples * channels * BYTES_PER_SAMPLE.get(frame.format.name, 2)
+        header = _header.pack(MSG_PCM, channels, self.id, frame.sample_rate,
+                              frame.pts or 0, size)
+        message = header + memoryview(frame.planes[0])[:size]
+        for consumer in list(consumers):
+            consumer.write(message)
+
+    def close(self):
+        if self.tap.streams.pop(self.id, None) is None:
+            return
+        message = _header.pack(MSG_STREAM_END, 0, self.id, 0, 0, 0)
+        for consumer in list(self.tap.consumers):
+            consumer.write(message)
+
+
+class AudioTap(object):
+    def __init__(self, path, high_water=HIGH_WATER, drop=DROP_NEWEST):
+        self.path = path
+        self.high_water = high_water
+        self.drop = drop
+        self.consumers = set()
+        self.streams = dict()  # id -> TapStream
+        self.next_id = 0
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise OSError('tap path %s exists and is not a socket' % self.path)
+            os.unlink(self.path)  # stale socket from previous run
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_unix_server(lambda: TapProtocol(self), self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for consumer in list(self.consumers):
+            consumer.transport.close()
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+
+    def stream(self, label):
+        if len(self.streams) > 0xffff:
+            raise OSError('no free tap stream id')
+        self.next_id = (self.next_id + 1) & 0xffff
+        while self.next_id in self.streams:  # wrapped around onto a live stream
+            self.next_id = (self.next_id + 1) & 0xffff
+        stream = TapStream(self, self.next_id, label)
+        self.streams[stream.id] = stream
+        message = stream.start_message()
+        for consumer in list(self.consumers):
+            consumer.write(message)
+        return stream
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Print what arrives on a tap socket')
+    parser.add_argument('path', help='Tap socket path')
+    args = parser.parse_args()
+
+    async def consume():
+        reader, writer = await asyncio.open_unix_connection(args.path)
+        labels = dict()
+        received = dict()
+        last = time.monotonic()
+        while True:
+            header = await reader.readexactly(_header.size)
+            kind, channels, stream_id, rate, pts, size = _header.unpack(header)
+            payload = await reader.readexactly(size)
+            if kind == MSG_STREAM_START:
+                labels[stream_id] = str(payload, 'utf-8')
+                print('stream %d started: %s' % (stream_id, labels[stream_id]))
+            elif kind == MSG_STREAM_END:
+                print('stream %d ended: %s' % (stream_id, labels.pop(stream_id, '?')))
+            else:
+                received[stream_id] = received.get(stream_id, 0) + size
+            if time.monotonic() - last >= 1.0:
+                last = time.monotonic()
+                for sid, count in received.items():
+                    print('%s: %d bytes/s' % (labels.get(sid, sid), count))
+                received.clear()
+
+    asyncio.run(consume())
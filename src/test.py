@@ -12,6 +12,7 @@ ROOT = os.path.dirname(__file__)
 
 logger = logging.getLogger("pc")
 managers = set()
+ROOM = "test"  # /mix puts every connection into one room
 
 
 async def index(request):
@@ -26,7 +27,7 @@ async def javascript(request):
 
 async def offer(request):
     params = await request.json()
-    manager = Connection()
+    manager = Connection(room=params.get("room", ROOM))
     managers.add(manager)
     answer = await manager.get_answer(sdp=params["sdp"], type=params["type"])
 
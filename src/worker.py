@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import queue
+import uuid
+
+import uvloop
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.codecs import CODECS, get_decoder, get_encoder
+from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder
+import protocol
+
+# Call worker for multiprocess_server.py.
+#
+# Workers are forked from a forkserver that imported this module once, so a
+# fresh worker starts with aiortc, av, numpy and codec tables already loaded
+# and only has to build its peer connection before answering. Forking the
+# server directly is about as fast, but copies its running loop, executor and
+# queue feeder threads (and any locks they hold) into every call.
+
+ROOT = os.path.dirname(__file__)
+PRELOAD = ['worker']
+OFFER_TIMEOUT = 5  # parent's queue feeder thread may not have flushed offer yet
+
+logger = logging.getLogger("pc")
+
+
+def warm_up():
+    """Create codec contexts once, forked workers inherit initialized codec libraries."""
+    for kind in ('audio', 'video'):
+        for codec in CODECS[kind]:
+            try:
+                get_encoder(codec)
+                get_decoder(codec)
+            except Exception:
+                pass
+
+
+async def config_pc(tx, rx, end_event, write_audio):
+    params = tx.get(True, OFFER_TIMEOUT)
+    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+    pc = RTCPeerConnection()
+    pc_id = "PeerConnection(%s)" % uuid.uuid4()
+
+    def log_info(msg, *args):
+        logger.info(pc_id + " " + msg, *args)
+
+    # prepare local media
+    player = MediaPlayer(os.path.join(ROOT, "Space Unicorn.mp3"))
+    if write_audio:
+        recorder = MediaRecorder(write_audio)
+    else:
+        recorder = MediaBlackhole()
+
+    stopping = asyncio.Event()
+
+    async def finish():
+        if stopping.is_set():
+            return
+        stopping.set()
+        await recorder.stop()
+        await pc.close()
+        rx.put_nowait("kill")
+        end_event.set()
+
+    @pc.on("datachannel")
+    def on_datachannel(channel):
+        control = protocol.MessageBatcher(channel)
+
+        @channel.on("message")
+        async def on_message(message):
+            if isinstance(message, str) and message.startswith("ping"):
+                channel.send("pong" + message[4:])
+            elif isinstance(message, bytes):
+                try:
+                    messages = protocol.decode(message)
+                except protocol.ProtocolError:
+                    return
+                for msg_type, value in messages:
+                    if msg_type == protocol.MSG_PING:
+                        control.send(protocol.MSG_PONG, value)
+                    elif msg_type == protocol.MSG_END_CALL:
+                        log_info("Call ended, reason %s", value)
+                        control.send(protocol.MSG_END_CALL, value)  # acknowledge with same reason
+                        control.flush()
+                        await finish()
+                        return
+
+    @pc.on("iceconnectionstatechange")
+    async def on_iceconnectionstatechange():
+        log_info("ICE connection state is %s", pc.iceConnectionState)
+        if pc.iceConnectionState == "failed":
+            await pc.close()
+
+    @pc.on("track")
+    def on_track(track):
+        log_info("Track %s received", track.kind)
+
+        if track.kind == "audio":
+            pc.addTrack(player.audio)
+            recorder.addTrack(track)
+        elif track.kind == "video":
+            local_video = track
+            pc.addTrack(local_video)
+
+        @track.on("ended")
+        async def on_ended():
+            log_info("Track %s ended", track.kind)
+            await finish()
+
+    # handle offer
+    await pc.setRemoteDescription(offer)
+    await recorder.start()
+
+    # send answer
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+
+    rx.put_nowait({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type})
+
+    await wait_stop(tx)
+    log_info("Stopped by parent")
+    await finish()
+
+
+async def wait_stop(tx):
+    while True:
+        try:
+            command = tx.get_nowait()
+            if command == "stop":
+                break
+        except queue.Empty:
+            await asyncio.sleep(0.1)
+
+
+async def waiter(event):
+    print('waiting for it ...')
+    await event.wait()
+    print('... got it!')
+
+
+def spawn_pc(tx, rx, write_audio=None, log_level=logging.INFO):
+    # forkserver children don't inherit logging configured by the server
+    logging.basicConfig(level=log_level)
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    end_event = asyncio.Event()
+    loop.create_task(config_pc(tx, rx, end_event, write_audio))
+    loop.run_until_complete(waiter(end_event))
+
+
+warm_up()
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    import time
+    import worker  # children resolve target by module name, not __main__
+    from drain import wait_until
+
+    parser = argparse.ArgumentParser(description='Time to first answer of a fresh worker')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    async def make_offer():
+        client = RTCPeerConnection()
+        client.addTransceiver('audio')
+        client.createDataChannel('chat')
+        await client.setLocalDescription(await client.createOffer())
+        return client, {"sdp": client.localDescription.sdp, "type": client.localDescription.type}
+
+    async def first_answer(ctx):
+        client, offer = await make_offer()
+        tx, rx = ctx.Queue(), ctx.Queue()
+        tx.put_nowait(offer)
+        start = time.perf_counter()
+        p = ctx.Process(target=worker.spawn_pc, args=(tx, rx, None, logging.WARNING))
+        p.start()
+        answer = await asyncio.get_event_loop().run_in_executor(None, rx.get, True, 30)
+        elapsed = time.perf_counter() - start
+        # finish handshake, worker closing while ICE still starts leaves failed connect task
+        await client.setRemoteDescription(RTCSessionDescription(**answer))
+        await asyncio.wait_for(wait_until(
+            lambda: client.iceConnectionState in ('completed', 'failed')), 10)
+        tx.put_nowait("stop")
+        p.join(5)
+        if p.is_alive():
+            p.terminate()
+        await client.close()
+        return elapsed
+
+    async def main():
+        for method in ('fork', 'spawn', 'forkserver'):
+            ctx = multiprocessing.get_context(method)
+            if method == 'forkserver':
+                ctx.set_forkserver_preload(PRELOAD)
+                await first_answer(ctx)  # starts forkserver, not measured
+            times = [await first_answer(ctx) for _ in range(args.runs)]
+            print('%-11s avg %7.1f ms  min %7.1f ms  max %7.1f ms' % (
+                method, sum(times) / len(times) * 1000, min(times) * 1000, max(times) * 1000))
+
+    asyncio.run(main())